@@ -1,18 +1,459 @@
+import hashlib
+import json
+import lzma
 import sqlite3
-import shutil
 import os
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
-def backup_database(source_db="meeting_room.db", backup_dir="backups"):
-    """Создание бекапа базы данных"""
+from migrations import JOURNALED_TABLES
+
+# Онлайн-бекап копирует базу порциями страниц и делает паузу между ними,
+# чтобы не держать блокировку и диск бота надолго
+BACKUP_PAGES_PER_STEP = 256
+BACKUP_STEP_PAUSE = 0.05
+# Запись в базу другим соединением между шагами (и в режиме WAL тоже) начинает копирование
+# заново; после стольких перезапусков база копируется за один шаг
+BACKUP_MAX_RESTARTS = 3
+
+# Бекапы хранятся сжатыми в xz; размеры и контрольные суммы - в манифесте
+BACKUP_SUFFIX = ".db.xz"
+DELTA_SUFFIX = ".jsonl.xz"
+BACKUP_LZMA_PRESET = 6
+MANIFEST_FILE = "manifest.json"
+# Проверенная копия для горячей замены: бот подхватывает её и сам переименовывает в базу
+INCOMING_SUFFIX = ".incoming"
+CHUNK_SIZE = 1024 * 1024
+
+# Инкрементальный режим: полный бекап - база цепочки, дальше дельты из журнала
+# change_journal; после FULL_BACKUP_EVERY дельт цепочка начинается заново
+FULL_BACKUP_EVERY = 24
+JOURNAL_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Многоуровневое хранение полных бекапов: по последнему за каждый час в течение
+# hourly часов, за каждый день - daily дней, за каждый месяц - monthly месяцев (None - всегда)
+DEFAULT_RETENTION = {'hourly': 24, 'daily': 30, 'monthly': None}
+
+class _BackupRestarted(Exception):
+    pass
+
+def _online_backup(source, target, pages, pause):
+    """source.backup порциями; при частых перезапусках из-за записей в источник - одним шагом"""
+    state = {'remaining': None, 'restarts': 0}
     
-    # Создаем директорию для бекапов, если её нет
-    os.makedirs(backup_dir, exist_ok=True)
+    def progress(status, remaining, total):
+        # Вызывается между шагами, когда блокировка источника уже отпущена.
+        # После перезапуска копирование идёт с первой страницы - remaining не убывает
+        if state['remaining'] is not None and remaining >= state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] >= BACKUP_MAX_RESTARTS:
+                raise _BackupRestarted()
+        state['remaining'] = remaining
+        if remaining and pause:
+            time.sleep(pause)
+    
+    try:
+        source.backup(target, pages=pages, progress=progress)
+    except _BackupRestarted:
+        # Один шаг держит блокировку чтения до конца копии, перезапусков не бывает
+        source.backup(target, pages=-1)
+
+def copy_database(source_path, target_path, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE,
+                  standalone=True):
+    """Согласованная копия базы через SQLite backup API (работает и на живой базе)"""
+    source = sqlite3.connect(source_path, timeout=30)
+    target = sqlite3.connect(target_path)
+    try:
+        _online_backup(source, target, pages, pause)
+        if standalone:
+            # Снимок - самостоятельный файл, без -wal / -shm рядом
+            target.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        target.close()
+        source.close()
+
+def verify_database(db_path):
+    """PRAGMA quick_check; возвращает None, если база цела, иначе текст ошибки"""
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute("PRAGMA quick_check").fetchall()
+    except sqlite3.DatabaseError as e:
+        return str(e)
+    finally:
+        conn.close()
+    result = "; ".join(row[0] for row in rows)
+    return None if result == "ok" else result
+
+def has_journal(conn):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'change_journal'"
+    ).fetchone() is not None
+
+def _has_journal_file(path):
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        return has_journal(conn)
+    finally:
+        conn.close()
+
+def journal_position(conn):
+    """Последний номер в журнале изменений; None, если журнала в базе нет"""
+    if not has_journal(conn):
+        return None
+    seq = conn.execute("SELECT MAX(seq) FROM change_journal").fetchone()[0]
+    if seq is None:
+        # Журнал пуст (например, сразу после начала цепочки) - номера продолжают sqlite_sequence
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_journal'").fetchone()
+        seq = row[0] if row else 0
+    return seq
+
+def _file_chunks(path):
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+
+def write_archive(chunks, archive_path):
+    """Потоковое сжатие порций байтов в xz; возвращает (sha256, размер архива)"""
+    compressor = lzma.LZMACompressor(format=lzma.FORMAT_XZ, preset=BACKUP_LZMA_PRESET)
+    digest = hashlib.sha256()
+    compressed_size = 0
+    with open(archive_path, 'wb') as f:
+        for chunk in chunks:
+            chunk = compressor.compress(chunk)
+            if chunk:
+                digest.update(chunk)
+                f.write(chunk)
+                compressed_size += len(chunk)
+        chunk = compressor.flush()
+        digest.update(chunk)
+        f.write(chunk)
+        compressed_size += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    return digest.hexdigest(), compressed_size
+
+def extract_archive(archive_path, target_path):
+    """Потоковая распаковка архива в файл; возвращает sha256 архива"""
+    decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    digest = hashlib.sha256()
+    with open(archive_path, 'rb') as src, open(target_path, 'wb') as dst:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            dst.write(decompressor.decompress(chunk))
+        if not decompressor.eof:
+            raise lzma.LZMAError("Archive is truncated")
+    return digest.hexdigest()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(backup_dir="backups"):
+    """Манифест бекапов: {имя файла: {kind, created, source, size, compressed_size, sha256, ...}}
     
-    # Генерируем имя файла бекапа с текущей датой и временем
+    kind = 'full' (seq - позиция журнала изменений в снимке) или 'delta'
+    (chain - полный бекап цепочки, изменения журнала from_seq < seq <= to_seq)
+    """
+    path = os.path.join(backup_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('backups', {})
+
+def save_manifest(manifest, backup_dir="backups"):
+    path = os.path.join(backup_dir, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'backups': manifest}, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def _add_to_manifest(backup_dir, backup_filename, entry):
+    manifest = load_manifest(backup_dir)
+    manifest[backup_filename] = entry
+    save_manifest(manifest, backup_dir)
+
+def import_legacy_backups(backup_dir="backups"):
+    """Несжатые бекапы старого формата (*.db) попадают в манифест с временем из mtime,
+    чтобы их показывал list и удаляла ротация; возвращает манифест"""
+    manifest = load_manifest(backup_dir)
+    if not os.path.isdir(backup_dir):
+        return manifest
+    legacy = [name for name in os.listdir(backup_dir)
+              if name.startswith("meeting_room_") and name.endswith(".db") and name not in manifest]
+    for name in legacy:
+        path = os.path.join(backup_dir, name)
+        size = os.path.getsize(path)
+        manifest[name] = {
+            'kind': 'full',
+            'created': datetime.fromtimestamp(os.path.getmtime(path)).isoformat(timespec='seconds'),
+            'source': None,
+            'size': size,
+            'compressed_size': size,
+            'sha256': file_sha256(path),
+            'seq': None,
+        }
+    if legacy:
+        save_manifest(manifest, backup_dir)
+        print(f"📥 В манифест добавлены бекапы старого формата: {len(legacy)}")
+    return manifest
+
+def backup_name(backup_dir, prefix, suffix):
+    """Имя бекапа с отметкой времени; второй бекап в ту же секунду получает номер"""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup_filename = f"meeting_room_backup_{timestamp}.db"
+    manifest = load_manifest(backup_dir)
+    name = f"{prefix}_{timestamp}{suffix}"
+    number = 1
+    while name in manifest or os.path.exists(os.path.join(backup_dir, name)):
+        name = f"{prefix}_{timestamp}_{number}{suffix}"
+        number += 1
+    return name
+
+def _by_created(manifest, kind=None):
+    """Имена бекапов, новые первыми"""
+    names = [name for name, entry in manifest.items() if kind is None or entry.get('kind', 'full') == kind]
+    return sorted(names, key=lambda name: (manifest[name]['created'], name), reverse=True)
+
+def create_archive(source_db, backup_dir, backup_filename,
+                   pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE):
+    """Снимок базы -> xz-архив в backup_dir -> запись в манифесте; возвращает запись.
+    
+    Снимок пишется backup API во временный файл рядом с архивом и сжимается
+    потоком по CHUNK_SIZE: в памяти база целиком не держится.
+    """
     backup_path = os.path.join(backup_dir, backup_filename)
+    # Пока архив не дописан, он лежит под временным именем и не участвует в ротации
+    partial_path = backup_path + ".partial"
+    snapshot_path = backup_path + ".snapshot"
+    try:
+        copy_database(source_db, snapshot_path, pages=pages, pause=pause)
+        error = verify_database(snapshot_path)
+        if error is not None:
+            raise sqlite3.DatabaseError(f"Snapshot failed quick_check: {error}")
+        snapshot = sqlite3.connect(snapshot_path)
+        try:
+            seq = journal_position(snapshot)
+        finally:
+            snapshot.close()
+        size = os.path.getsize(snapshot_path)
+        sha256, compressed_size = write_archive(_file_chunks(snapshot_path), partial_path)
+        os.replace(partial_path, backup_path)
+    finally:
+        for path in (snapshot_path, partial_path):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    entry = {
+        'kind': 'full',
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'source': source_db,
+        'size': size,
+        'compressed_size': compressed_size,
+        'sha256': sha256,
+        'seq': seq,
+    }
+    _add_to_manifest(backup_dir, backup_filename, entry)
+    return entry
+
+def open_chain(source_db):
+    """Включение журнала изменений до снимка: правки во время снимка попадут в первую дельту.
+    
+    Пустое значение - цепочка ещё без полного бекапа; start_chain запишет его имя.
+    """
+    conn = sqlite3.connect(source_db, timeout=30, isolation_level=None)
+    try:
+        conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('backup_chain', '')")
+    finally:
+        conn.close()
+
+def end_chain(source_db):
+    """Выключение журнала изменений: без цепочки дельты не нужны"""
+    conn = sqlite3.connect(source_db, timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("DELETE FROM meta WHERE key = 'backup_chain'")
+        conn.execute("DELETE FROM change_journal")
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+def start_chain(source_db, backup_filename, seq):
+    """Отметка в базе, что следующие дельты считаются от этого полного бекапа.
+    
+    Строки журнала до seq уже вошли в снимок и удаляются.
+    """
+    conn = sqlite3.connect(source_db, timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('backup_chain', ?)", (backup_filename,))
+        conn.execute("DELETE FROM change_journal WHERE seq <= ?", (seq,))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+def chain_deltas(manifest, base, last_seq=None):
+    """Дельты цепочки по порядку (до last_seq включительно); разрыв в цепочке - ошибка"""
+    deltas = sorted(
+        (name for name, entry in manifest.items()
+         if entry.get('kind') == 'delta' and entry['chain'] == base
+         and (last_seq is None or entry['to_seq'] <= last_seq)),
+        key=lambda name: manifest[name]['from_seq']
+    )
+    position = manifest[base].get('seq')
+    for name in deltas:
+        if manifest[name]['from_seq'] != position:
+            raise ValueError(f"Backup chain {base} is broken before {name}")
+        position = manifest[name]['to_seq']
+    return deltas
+
+def current_chain(source_db, manifest):
+    """(полный бекап цепочки, последний seq в ней, число дельт) или None, если нужен полный бекап"""
+    bases = [name for name in _by_created(manifest, 'full') if manifest[name].get('seq') is not None]
+    if not bases:
+        return None
+    base = bases[0]
+    
+    conn = sqlite3.connect(source_db, timeout=30)
+    try:
+        if not has_journal(conn):
+            return None
+        row = conn.execute("SELECT value FROM meta WHERE key = 'backup_chain'").fetchone()
+    finally:
+        conn.close()
+    # После восстановления или полного бекапа в другой каталог цепочка в базе другая
+    if row is None or row[0] != base:
+        return None
+    
+    deltas = chain_deltas(manifest, base)
+    last_seq = manifest[deltas[-1]]['to_seq'] if deltas else manifest[base]['seq']
+    return base, last_seq, len(deltas)
+
+def create_delta(source_db, backup_dir, backup_filename, chain, from_seq):
+    """Строки журнала после from_seq -> xz-архив JSON Lines; None, если изменений нет"""
+    backup_path = os.path.join(backup_dir, backup_filename)
+    partial_path = backup_path + ".partial"
+    state = {'to_seq': from_seq, 'changes': 0, 'size': 0}
+    
+    conn = sqlite3.connect(source_db, timeout=30)
+    try:
+        rows = conn.execute(
+            "SELECT seq, table_name, op, row_data, changed_at FROM change_journal WHERE seq > ? ORDER BY seq",
+            (from_seq,)
+        )
+        
+        def lines():
+            for seq, table, op, row_data, changed_at in rows:
+                change = {'seq': seq, 'table': table, 'op': op,
+                          'data': json.loads(row_data), 'changed_at': changed_at}
+                line = (json.dumps(change, ensure_ascii=False) + "\n").encode('utf-8')
+                state['to_seq'] = seq
+                state['changes'] += 1
+                state['size'] += len(line)
+                yield line
+        
+        try:
+            sha256, compressed_size = write_archive(lines(), partial_path)
+            if state['changes']:
+                os.replace(partial_path, backup_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+    finally:
+        conn.close()
+    
+    if not state['changes']:
+        return None
+    
+    entry = {
+        'kind': 'delta',
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'source': source_db,
+        'size': state['size'],
+        'compressed_size': compressed_size,
+        'sha256': sha256,
+        'chain': chain,
+        'from_seq': from_seq,
+        'to_seq': state['to_seq'],
+        'changes': state['changes'],
+    }
+    _add_to_manifest(backup_dir, backup_filename, entry)
+    return entry
+
+def read_delta(delta_path):
+    """Изменения из дельты по одному, с потоковой распаковкой"""
+    with lzma.open(delta_path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+def apply_change(conn, change):
+    """Применение одной строки журнала: upsert всей строки или удаление по ключу"""
+    table = change['table']
+    if table not in JOURNALED_TABLES:
+        raise ValueError(f"Unexpected table in change journal: {table!r}")
+    key = JOURNALED_TABLES[table]
+    data = change['data']
+    
+    if change['op'] == 'delete':
+        conn.execute(f"DELETE FROM {table} WHERE {key} = ?", (data[key],))
+        return
+    
+    # ON CONFLICT DO UPDATE, а не INSERT OR REPLACE: замена строки не запускает
+    # триггеры удаления, и сводные таблицы статистики разошлись бы с stats
+    present = [row[1] for row in conn.execute(f"PRAGMA table_info({table})") if row[1] in data]
+    updates = ", ".join(f"{column} = excluded.{column}" for column in present if column != key)
+    conn.execute(
+        f"INSERT INTO {table} ({', '.join(present)}) VALUES ({', '.join('?' for _ in present)}) "
+        f"ON CONFLICT ({key}) DO UPDATE SET {updates}",
+        [data[column] for column in present]
+    )
+
+def replay_deltas(db_path, backup_dir, manifest, deltas, until=None):
+    """Накат дельт на распакованную базу (изменения до момента until включительно); возвращает их число"""
+    limit = until.strftime(JOURNAL_TIME_FORMAT) if until is not None else None
+    applied = 0
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute("BEGIN")
+        try:
+            for name in deltas:
+                delta_path = os.path.join(backup_dir, name)
+                if file_sha256(delta_path) != manifest[name]['sha256']:
+                    raise ValueError(f"Checksum mismatch for {name}")
+                for change in read_delta(delta_path):
+                    if limit is not None and change['changed_at'] > limit:
+                        break
+                    apply_change(conn, change)
+                    applied += 1
+                else:
+                    continue
+                break
+            
+            if has_journal(conn):
+                # Восстановленная база начнёт новую цепочку со следующего полного бекапа
+                conn.execute("DELETE FROM change_journal")
+                conn.execute("DELETE FROM meta WHERE key = 'backup_chain'")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    return applied
+
+def backup_database(source_db="meeting_room.db", backup_dir="backups",
+                    pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE, keep_last=5,
+                    incremental=False, full_every=FULL_BACKUP_EVERY, retention=None):
+    """Создание бекапа базы данных (incremental - дельта к последнему полному бекапу, если возможно).
+
+    retention - уровни хранения (см. DEFAULT_RETENTION) вместо keep_last последних.
+    """
+    
+    # Создаем директорию для бекапов, если её нет
+    os.makedirs(backup_dir, exist_ok=True)
     
     try:
         # Проверяем, существует ли исходная база данных
@@ -20,33 +461,105 @@ def backup_database(source_db="meeting_room.db", backup_dir="backups"):
             print(f"❌ Файл базы данных {source_db} не найден!")
             return False
         
-        # Создаем бекап
-        shutil.copy2(source_db, backup_path)
+        started = time.monotonic()
+        if incremental:
+            chain = current_chain(source_db, load_manifest(backup_dir))
+            if chain is not None and chain[2] < full_every:
+                base, last_seq, _ = chain
+                backup_filename = backup_name(backup_dir, "meeting_room_delta", DELTA_SUFFIX)
+                entry = create_delta(source_db, backup_dir, backup_filename, base, last_seq)
+                if entry is None:
+                    print("✅ Изменений с последнего бекапа нет")
+                else:
+                    print(f"✅ Инкрементальный бекап создан: {os.path.join(backup_dir, backup_filename)} "
+                          f"({entry['changes']} изменений, {time.monotonic() - started:.1f} с)")
+                    print(f"📦 Размер бекапа: {entry['compressed_size']} байт")
+                return True
         
-        print(f"✅ Бекап создан: {backup_path}")
-        print(f"📦 Размер бекапа: {os.path.getsize(backup_path)} байт")
+        # Создаем полный бекап
+        backup_filename = backup_name(backup_dir, "meeting_room_backup", BACKUP_SUFFIX)
+        journaled = _has_journal_file(source_db)
+        if journaled and incremental:
+            open_chain(source_db)
+        entry = create_archive(source_db, backup_dir, backup_filename, pages=pages, pause=pause)
+        if journaled:
+            if incremental:
+                start_chain(source_db, backup_filename, entry['seq'])
+            else:
+                end_chain(source_db)
         
-        # Удаляем старые бекапы (оставляем только последние 5)
-        cleanup_old_backups(backup_dir)
+        print(f"✅ Бекап создан: {os.path.join(backup_dir, backup_filename)} ({time.monotonic() - started:.1f} с)")
+        print(f"📦 Размер бекапа: {entry['compressed_size']} байт из {entry['size']} "
+              f"({compression_ratio(entry):.1%})")
         
-        return True
+        # Удаляем старые бекапы (последние keep_last полных или по уровням хранения)
+        cleanup_old_backups(backup_dir, keep_last, retention)
         
+        return True
+    
     except Exception as e:
         print(f"❌ Ошибка при создании бекапа: {e}")
         return False
 
-def cleanup_old_backups(backup_dir="backups", keep_last=5):
-    """Удаление старых бекапов (оставляем последние N)"""
+def compression_ratio(entry):
+    """Доля размера архива от размера базы"""
+    return entry['compressed_size'] / entry['size'] if entry['size'] else 0.0
+
+def retained_backups(manifest, retention, now=None):
+    """Полные бекапы, которые оставляет многоуровневое хранение.
+    
+    В каждом часе, дне и месяце внутри окна уровня остаётся самый новый бекап;
+    самый последний бекап остаётся всегда.
+    """
+    now = now or datetime.now()
+    retention = dict(DEFAULT_RETENTION, **retention)
+    fulls = _by_created(manifest, 'full')
+    keep = set(fulls[:1])
+    # Уровень: число периодов, длина ключа периода в created (ГГГГ-ММ-ДДTЧЧ), длина периода
+    tiers = (
+        (retention.get('hourly'), 13, timedelta(hours=1)),
+        (retention.get('daily'), 10, timedelta(days=1)),
+        (retention.get('monthly'), 7, timedelta(days=31)),
+    )
+    for count, key_length, period in tiers:
+        if count == 0:
+            continue
+        since = None if count is None else (now - count * period).isoformat(timespec='seconds')
+        seen = set()
+        for name in fulls:  # новые первыми - в каждый период попадает самый новый
+            created = manifest[name]['created']
+            if since is not None and created < since:
+                break
+            if created[:key_length] not in seen:
+                seen.add(created[:key_length])
+                keep.add(name)
+    return keep
+
+def cleanup_old_backups(backup_dir="backups", keep_last=5, retention=None):
+    """Удаление старых бекапов (последние N полных или по уровням retention, вместе с дельтами)"""
     
     try:
-        backup_files = [f for f in os.listdir(backup_dir) if f.endswith('.db')]
-        backup_files.sort(reverse=True)  # Сортируем по убыванию (новые первыми)
+        manifest = import_legacy_backups(backup_dir)
+        # Время создания берём из манифеста, а не из имени файла
+        if retention is not None:
+            old_backups = set(_by_created(manifest, 'full')) - retained_backups(manifest, retention)
+        else:
+            old_backups = set(_by_created(manifest, 'full')[keep_last:])
+        old_backups.update(
+            name for name, entry in manifest.items()
+            if entry.get('kind') == 'delta' and (entry['chain'] in old_backups or entry['chain'] not in manifest)
+        )
         
-        for old_backup in backup_files[keep_last:]:
+        for old_backup in sorted(old_backups):
             old_backup_path = os.path.join(backup_dir, old_backup)
-            os.remove(old_backup_path)
+            if os.path.exists(old_backup_path):
+                os.remove(old_backup_path)
+            del manifest[old_backup]
             print(f"🗑️ Удален старый бекап: {old_backup}")
-            
+        
+        if old_backups:
+            save_manifest(manifest, backup_dir)
+    
     except Exception as e:
         print(f"❌ Ошибка при удалении старых бекапов: {e}")
 
@@ -54,8 +567,8 @@ def list_backups(backup_dir="backups"):
     """Список всех бекапов"""
     
     try:
-        backup_files = [f for f in os.listdir(backup_dir) if f.endswith('.db')]
-        backup_files.sort(reverse=True)
+        manifest = import_legacy_backups(backup_dir)
+        backup_files = _by_created(manifest)
         
         if not backup_files:
             print("📦 Нет доступных бекапов")
@@ -63,59 +576,139 @@ def list_backups(backup_dir="backups"):
         
         print("📦 Доступные бекапы:")
         for i, backup_file in enumerate(backup_files, 1):
-            backup_path = os.path.join(backup_dir, backup_file)
-            size = os.path.getsize(backup_path)
-            print(f"  {i}. {backup_file} ({size} байт)")
-            
+            entry = manifest[backup_file]
+            if entry.get('kind') == 'delta':
+                print(f"  {i}. {backup_file} ({entry['compressed_size']} байт, "
+                      f"{entry['changes']} изменений к {entry['chain']})")
+            elif not backup_file.endswith(BACKUP_SUFFIX):
+                print(f"  {i}. {backup_file} ({entry['size']} байт, без сжатия)")
+            else:
+                print(f"  {i}. {backup_file} ({entry['compressed_size']} байт, "
+                      f"база {entry['size']} байт, {compression_ratio(entry):.1%})")
+    
     except Exception as e:
         print(f"❌ Ошибка при чтении списка бекапов: {e}")
 
-def restore_database(backup_file, target_db="meeting_room.db", backup_dir="backups"):
-    """Восстановление базы данных из бекапа"""
+def incoming_path(db_file):
+    return db_file + INCOMING_SUFFIX
+
+def restore_database(backup_file, target_db="meeting_room.db", backup_dir="backups", until=None, hot=False):
+    """Восстановление базы данных из бекапа.
+    
+    Для дельты восстанавливается полный бекап её цепочки и накатываются дельты до неё
+    включительно; until (datetime) ограничивает накат изменениями до этого момента.
+    hot - не трогать базу, а положить проверенную копию рядом (incoming_path), чтобы
+    запущенный бот заменил файл сам (DatabaseManager.replace_database).
+    """
     
     backup_path = os.path.join(backup_dir, backup_file)
+    restore_path = target_db + ".restore"
     
     try:
         if not os.path.exists(backup_path):
             print(f"❌ Файл бекапа {backup_path} не найден!")
             return False
         
-        # Создаем резервную копию текущей базы перед восстановлением
-        current_backup = f"meeting_room_before_restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        shutil.copy2(target_db, os.path.join(backup_dir, current_backup))
-        print(f"💾 Создана резервная копия текущей базы: {current_backup}")
+        if backup_file.endswith((BACKUP_SUFFIX, DELTA_SUFFIX)):
+            manifest = load_manifest(backup_dir)
+            entry = manifest.get(backup_file)
+            if entry is None:
+                print(f"❌ Бекап {backup_file} отсутствует в манифесте")
+                return False
+            
+            if entry.get('kind') == 'delta':
+                base = entry['chain']
+                deltas = chain_deltas(manifest, base, entry['to_seq'])
+            else:
+                base = backup_file
+                deltas = chain_deltas(manifest, base) if until is not None else []
+            
+            # Распаковываем потоком во временный файл, сверяя контрольную сумму по ходу
+            sha256 = extract_archive(os.path.join(backup_dir, base), restore_path)
+            if sha256 != manifest[base]['sha256']:
+                print("❌ Контрольная сумма бекапа не совпадает с манифестом")
+                return False
+            applied = replay_deltas(restore_path, backup_dir, manifest, deltas, until)
+            if deltas:
+                print(f"🔁 Накачено изменений из {len(deltas)} дельт: {applied}")
+        else:
+            # Несжатый бекап старого формата - тоже во временный файл через backup API
+            copy_database(backup_path, restore_path, pages=-1, pause=0)
+        
+        error = verify_database(restore_path)
+        if error is not None:
+            print(f"❌ Бекап не прошёл проверку целостности: {error}")
+            return False
+        
+        # Создаем резервную копию текущей базы перед восстановлением (если она есть:
+        # sqlite3.connect создал бы пустой файл, и он попал бы в архив)
+        if os.path.exists(target_db):
+            current_backup = backup_name(backup_dir, "meeting_room_before_restore", BACKUP_SUFFIX)
+            create_archive(target_db, backup_dir, current_backup)
+            print(f"💾 Создана резервная копия текущей базы: {current_backup}")
+        
+        if hot:
+            os.replace(restore_path, incoming_path(target_db))
+            print(f"✅ Копия из {backup_file} подготовлена: {incoming_path(target_db)}, "
+                  f"запущенный бот заменит базу в течение нескольких секунд")
+            return True
         
-        # Восстанавливаем базу данных
-        shutil.copy2(backup_path, target_db)
+        # Восстанавливаем базу данных через backup API: простое копирование файла
+        # поверх базы в режиме WAL смешало бы его со старым журналом -wal
+        copy_database(restore_path, target_db, pages=-1, pause=0, standalone=False)
         print(f"✅ База данных восстановлена из: {backup_file}")
         
         return True
-        
+    
     except Exception as e:
         print(f"❌ Ошибка при восстановлении базы данных: {e}")
         return False
+    finally:
+        if os.path.exists(restore_path):
+            os.remove(restore_path)
+
+def restore_to_time(until, target_db="meeting_room.db", backup_dir="backups", hot=False):
+    """Восстановление состояния на момент until: последний полный бекап до него плюс дельты"""
+    manifest = import_legacy_backups(backup_dir)
+    created_before = until.isoformat(timespec='seconds')
+    bases = [name for name in _by_created(manifest, 'full') if manifest[name]['created'] <= created_before]
+    if not bases:
+        print(f"❌ Нет полного бекапа, сделанного до {until}")
+        return False
+    return restore_database(bases[0], target_db, backup_dir, until=until, hot=hot)
 
 def main():
     import sys
     
-    if len(sys.argv) > 1:
-        command = sys.argv[1].lower()
+    # --hot: восстановление при запущенном боте, без его остановки
+    hot = "--hot" in sys.argv
+    args = [arg for arg in sys.argv if arg != "--hot"]
+    
+    if len(args) > 1:
+        command = args[1].lower()
         
         if command == "backup":
             backup_database()
+        elif command == "incremental":
+            backup_database(incremental=True)
         elif command == "list":
             list_backups()
-        elif command == "restore" and len(sys.argv) > 2:
-            backup_file = sys.argv[2]
-            restore_database(backup_file)
+        elif command == "restore" and len(args) > 2:
+            backup_file = args[2]
+            restore_database(backup_file, hot=hot)
+        elif command == "restore-at" and len(args) > 2:
+            restore_to_time(datetime.fromisoformat(" ".join(args[2:])), hot=hot)
         else:
             print("Использование:")
-            print("  python backup_db.py backup    - создать бекап")
+            print("  python backup_db.py backup    - создать полный бекап (цепочка дельт завершается)")
+            print("  python backup_db.py incremental - дельта к последнему полному бекапу")
             print("  python backup_db.py list      - список бекапов")
             print("  python backup_db.py restore [имя_бекапа] - восстановить из бекапа")
+            print("  python backup_db.py restore-at [ГГГГ-ММ-ДД ЧЧ:ММ:СС] - восстановить состояние на момент времени")
+            print("  --hot (с restore / restore-at) - подготовить копию для замены базы запущенным ботом")
     else:
         print("Создание бекапа базы данных...")
         backup_database()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,87 @@
+import logging
+import os
+import threading
+from datetime import datetime
+
+import backup
+
+logger = logging.getLogger(__name__)
+
+# Приоритет потока бекапов: на Linux без явного ioprio от nice зависит и приоритет ввода-вывода
+BACKUP_THREAD_NICE = 19
+
+class BackupScheduler:
+    """Периодические бекапы в фоновом потоке процесса бота.
+
+    Использует функции backup.py: полный бекап или дельту к нему, затем
+    многоуровневое хранение полных бекапов.
+    """
+
+    def __init__(self, db_file: str, backup_dir: str = "backups", interval_minutes: float = 60,
+                 incremental: bool = True, full_every: int = backup.FULL_BACKUP_EVERY,
+                 retention: dict = None, pause: float = backup.BACKUP_STEP_PAUSE):
+        self.db_file = db_file
+        self.backup_dir = backup_dir
+        self.interval = interval_minutes * 60
+        self.incremental = incremental
+        self.full_every = full_every
+        self.retention = dict(backup.DEFAULT_RETENTION, **(retention or {}))
+        self.pause = pause
+        self._thread = None
+        self._stop = threading.Event()
+        self.runs = 0
+        self.failures = 0
+        self.last_run = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="db-backup", daemon=True)
+        self._thread.start()
+        logger.info(f"Планировщик бекапов запущен (каждые {self.interval / 60:.0f} мин, каталог {self.backup_dir})")
+
+    def stop(self, timeout: float = 60.0):
+        """Остановка; идущий бекап доделывается"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _lower_priority(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), BACKUP_THREAD_NICE)
+        except (AttributeError, OSError) as e:
+            logger.warning(f"Не удалось понизить приоритет потока бекапов: {e}")
+
+    def _first_delay(self) -> float:
+        """Задержка до первого бекапа: отсчёт от последнего бекапа в манифесте, а не от запуска"""
+        try:
+            manifest = backup.load_manifest(self.backup_dir)
+        except (OSError, ValueError):
+            return 0.0
+        if not manifest:
+            return 0.0
+        latest = max(entry['created'] for entry in manifest.values())
+        elapsed = (datetime.now() - datetime.fromisoformat(latest)).total_seconds()
+        return max(0.0, self.interval - elapsed)
+
+    def _run(self):
+        self._lower_priority()
+        delay = self._first_delay()
+        while not self._stop.wait(delay):
+            self.run_once()
+            delay = self.interval
+
+    def run_once(self) -> bool:
+        ok = backup.backup_database(
+            self.db_file, self.backup_dir, pause=self.pause,
+            incremental=self.incremental, full_every=self.full_every, retention=self.retention
+        )
+        self.runs += 1
+        self.last_run = datetime.now()
+        if not ok:
+            self.failures += 1
+            logger.error("Плановый бекап базы не удался")
+        return ok
@@ -1,3 +1,4 @@
+import os
 import re
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
@@ -8,9 +9,14 @@ from datetime import datetime, timedelta
 
 from config import config
 # В начале файла добавь:
-from database import init_db_manager, get_db_manager
-import threading
-import time as time_module
+from database import init_db_manager, get_db_manager, close_db_manager
+from notifications import ReminderDispatcher, ReminderScheduler
+from sessions import SessionStore, SQLiteSessionStore
+from keyboards import KeyboardCache
+from router import CallbackRouter, parse_choice, parse_date, parse_time
+from write_queue import WriteQueue
+from backup_scheduler import BackupScheduler
+from backup import incoming_path
 
 
 
@@ -30,93 +36,168 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
-# Глобальные переменные для уведомлений
-notification_thread = None
-stop_notification_thread = False
+# Планировщик уведомлений
+reminder_scheduler = None
+
+# Очередь записи в базу (режим concurrency.enabled)
+WRITE_QUEUE = None
+
+# Плановые бекапы в фоновом потоке (backups.enabled)
+BACKUP_SCHEDULER = None
+# Как часто проверять, не подготовлена ли копия базы для горячей замены (backup.py restore --hot)
+INCOMING_DATABASE_CHECK_SECONDS = 5
+
+# Клавиатуры бронирования строятся один раз в сутки (и при перезагрузке настроек)
+KEYBOARDS = KeyboardCache(config)
 
 # Получение списка доступных дат
 def get_available_dates():
-    dates = []
-    for i in range(config.booking_range_days):
-        date = datetime.now() + timedelta(days=i)
-        dates.append(date.strftime("%d.%m.%Y"))
-    return dates
+    return KEYBOARDS.dates()
 
 # Получение доступного времени
 def get_time_matrix():
-    times = []
-    start_hour = config.get_working_start_time().hour
-    end_hour = config.get_working_end_time().hour
-    
-    for hour in range(start_hour, end_hour + 1):
-        times.append(f"{hour:02d}:00")
-        if hour < end_hour:
-            times.append(f"{hour:02d}:30")
-    return times
+    return KEYBOARDS.times()
 
 
-# Отправка уведомления пользователю
+# Отправка уведомления пользователю (ошибки обрабатывает ReminderDispatcher: повтор с паузой)
 def send_notification(bot, user_id, booking_info):
-    try:
-        message = config.notifications['reminder_message'].format(
-            minutes=config.notifications['reminder_minutes'],
-            date=booking_info['date'],
-            start_time=booking_info['start_time'],
-            end_time=booking_info['end_time']
-        )
-        bot.send_message(chat_id=user_id, text=message, parse_mode='Markdown')
-        logger.info(f"Уведомление отправлено пользователю {user_id}")
-    except Exception as e:
-        logger.error(f"Ошибка отправки уведомления пользователю {user_id}: {e}")
-
-# Фоновый поток для уведомлений
-def notification_worker(bot):
-    """Фоновый поток для отправки уведомлений"""
-    global stop_notification_thread
-    
-    while not stop_notification_thread:
-        try:
-            if config.notifications['enable']:
-                db_manager = get_db_manager()
-                bookings = db_manager.get_bookings_for_notification(config.notifications['reminder_minutes'])
-                for booking in bookings:
-                    booking_id, user_id, user_name, date, start_time, end_time = booking
-                    
-                    booking_info = {
-                        'date': date,
-                        'start_time': start_time,
-                        'end_time': end_time
-                    }
-                    
-                    send_notification(bot, user_id, booking_info)
-                    db_manager.mark_as_notified(booking_id)
-                    
-            # Проверяем каждую минуту
-            time_module.sleep(60)
-            
-        except Exception as e:
-            logger.error(f"Ошибка в потоке уведомлений: {e}")
-            time_module.sleep(60)
+    message = config.notifications['reminder_message'].format(
+        minutes=config.notifications['reminder_minutes'],
+        date=booking_info['date'],
+        start_time=booking_info['start_time'],
+        end_time=booking_info['end_time']
+    )
+    bot.send_message(chat_id=user_id, text=message, parse_mode='Markdown')
 
-# Запуск потока уведомлений
+# Отправка напоминания из очереди outbox
+def send_booking_reminder(bot, reminder):
+    reminder_id, user_id, user_name, date, start_time, end_time = reminder
+    
+    booking_info = {
+        'date': date,
+        'start_time': start_time,
+        'end_time': end_time
+    }
+    
+    send_notification(bot, user_id, booking_info)
+
+# Запуск планировщика уведомлений
 def start_notification_thread(bot):
-    global notification_thread, stop_notification_thread
+    global reminder_scheduler
+    
+    if not config.notifications['enable']:
+        return
     
-    if notification_thread is None or not notification_thread.is_alive():
-        stop_notification_thread = False
-        notification_thread = threading.Thread(target=notification_worker, args=(bot,), daemon=True)
-        notification_thread.start()
-        logger.info("Поток уведомлений запущен")
+    if reminder_scheduler is None:
+        dispatcher = ReminderDispatcher(
+            lambda reminder: send_booking_reminder(bot, reminder),
+            senders=config.notifications.get('senders', 4),
+            global_rate=config.notifications.get('global_rate_per_second', 30),
+            per_chat_rate=config.notifications.get('per_chat_rate_per_second', 1),
+            max_attempts=config.notifications.get('max_attempts', 3)
+        )
+        reminder_scheduler = ReminderScheduler(
+            get_db_manager(),
+            config.notifications['reminder_minutes'],
+            dispatcher,
+            max_attempts=config.notifications.get('outbox_max_attempts', 5)
+        )
+    reminder_scheduler.start()
 
-# Остановка потока уведомлений
+# Остановка планировщика уведомлений
 def stop_notification_thread_func():
-    global stop_notification_thread
-    stop_notification_thread = True
-    logger.info("Поток уведомлений остановлен")
+    global reminder_scheduler
+    
+    if reminder_scheduler is not None:
+        reminder_scheduler.stop()
+        reminder_scheduler = None
+
+
+# Запись в базу: в параллельном режиме - через единственный поток-писатель.
+# Исключение - outbox напоминаний (claim/ack/fail_reminders, sync_outbox): его пишет
+# один фоновый поток короткими транзакциями, и переполненная очередь не должна
+# задерживать отправку напоминаний
+def write_db(func, *args):
+    if WRITE_QUEUE is None:
+        return func(*args)
+    return WRITE_QUEUE.call(func, *args)
+
+def start_write_queue():
+    global WRITE_QUEUE
+    
+    if WRITE_QUEUE is None:
+        WRITE_QUEUE = WriteQueue(max_size=config.concurrency.get('write_queue_size', 100))
+        WRITE_QUEUE.start()
+
+def stop_write_queue():
+    global WRITE_QUEUE
+    
+    if WRITE_QUEUE is not None:
+        WRITE_QUEUE.stop()
+        WRITE_QUEUE = None
+
+def start_backup_scheduler():
+    global BACKUP_SCHEDULER
+    
+    if BACKUP_SCHEDULER is None:
+        settings = config.backups
+        BACKUP_SCHEDULER = BackupScheduler(
+            config.database_file,
+            backup_dir=settings.get('directory', 'backups'),
+            interval_minutes=settings.get('interval_minutes', 60),
+            incremental=settings.get('incremental', True),
+            full_every=settings.get('full_every', 24),
+            retention=settings.get('retention')
+        )
+        BACKUP_SCHEDULER.start()
+
+def stop_backup_scheduler():
+    global BACKUP_SCHEDULER
+    
+    if BACKUP_SCHEDULER is not None:
+        BACKUP_SCHEDULER.stop()
+        BACKUP_SCHEDULER = None
 
+def apply_incoming_database(context: CallbackContext = None):
+    """Горячая замена базы проверенной копией, подготовленной `backup.py restore --hot`"""
+    incoming = incoming_path(config.database_file)
+    if not os.path.exists(incoming):
+        return
+    
+    try:
+        elapsed = get_db_manager().replace_database(incoming)
+    except Exception as e:
+        logger.error(f"Не удалось заменить базу данных восстановленной копией: {e}")
+        return
+    logger.info(f"База данных заменена восстановленной копией за {elapsed * 1000:.0f} мс")
+
+# Метрики обработки обновлений в лог (периодически и при остановке)
+def log_metrics(context: CallbackContext = None):
+    metrics = ROUTER.format_metrics()
+    if metrics:
+        logger.info(f"Метрики кнопок:\n{metrics}")
+    
+    renders = get_db_manager().render_cache.metrics()
+    if renders['hits'] or renders['misses']:
+        logger.info(
+            f"Кэш сообщений: записей {renders['entries']}, попаданий {renders['hits']}, "
+            f"промахов {renders['misses']} ({renders['hit_rate']:.0%} попаданий)"
+        )
+    
+    if WRITE_QUEUE is not None:
+        workers = config.concurrency.get('workers', 4)
+        in_flight = ROUTER.concurrency_metrics()
+        writes = WRITE_QUEUE.metrics()
+        logger.info(
+            f"Параллельная обработка: потоков {workers}, выполняется {in_flight['in_flight']} "
+            f"(максимум {in_flight['max_in_flight']}); очередь записи {writes['depth']}/{writes['max_size']} "
+            f"(максимум {writes['max_depth']}), записей {writes['processed']}, ошибок {writes['errors']}, "
+            f"ожидание в среднем {writes['avg_wait_ms']:.1f} мс, максимум {writes['max_wait_ms']:.1f} мс"
+        )
 
 # Состояния пользователя
-USER_STATES = {}
+# Сессии незавершённых бронирований; в main() может быть заменено хранилищем в SQLite
+USER_STATES = SessionStore(ttl=config.sessions.get('ttl_minutes', 30) * 60)
 
 class BookingState:
     DATE = "date"
@@ -150,7 +231,7 @@ def start(update: Update, context: CallbackContext):
     
     # Сохраняем информацию о пользователе
     db_manager = get_db_manager()
-    db_manager.save_user(user_id, user_name, first_name, last_name)
+    write_db(db_manager.save_user, user_id, user_name, first_name, last_name)
 
     welcome_text = (
         "👋 *Добро пожаловать в бота для бронирования переговорной комнаты!* \n\n"
@@ -207,109 +288,70 @@ def start_booking(update: Update, context: CallbackContext):
     user_id = query.from_user.id
     
     # Очищаем предыдущее состояние
-    USER_STATES[user_id] = {
-        'state': BookingState.DATE, 
-        'user_id': user_id, 
-        'user_name': query.from_user.username or query.from_user.first_name
-    }
+    USER_STATES.start(user_id, query.from_user.username or query.from_user.first_name, BookingState.DATE)
     
-    keyboard = []
-    dates = get_available_dates()
-    
-    # Создаём матрицу дат 2x4
-    row = []
-    for i, date in enumerate(dates):
-        row.append(InlineKeyboardButton(date, callback_data=f"date_{date}"))
-        if (i + 1) % 2 == 0:
-            keyboard.append(row)
-            row = []
-    
-    if row:
-        keyboard.append(row)
-    
-    # Добавляем кнопку "Назад"
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Матрица дат 2x7 - готовая клавиатура из кэша
+    reply_markup = KEYBOARDS.date_keyboard()
     query.edit_message_text("📅 *Выберите дату для бронирования:*", reply_markup=reply_markup, parse_mode='Markdown')
 
 # Выбор времени начала
-def show_time_picker(update: Update, context: CallbackContext):
+def show_time_picker(update: Update, context: CallbackContext, date: str):
     query = update.callback_query
     user_id = query.from_user.id
     
-    if user_id not in USER_STATES:
+    session = USER_STATES.get(user_id)
+    if session is None:
         return
     
-    date = query.data.split("_", 1)[1]
-    USER_STATES[user_id]['date'] = date
-    USER_STATES[user_id]['state'] = BookingState.START_TIME
+    session.date = date
+    session.state = BookingState.START_TIME
+    USER_STATES.save(session)
     
-    # Создаём матрицу времени 4x4
-    times = get_time_matrix()
-    keyboard = []
-    
-    # Разбиваем на строки по 4 кнопки
-    for i in range(0, len(times), 4):
-        row_times = times[i:i+4]
-        row = []
-        for time in row_times:
-            row.append(InlineKeyboardButton(time, callback_data=f"start_{time}"))
-        keyboard.append(row)
-    
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="book_room")])
+    # Занятое время показываем неактивным - одним обращением к индексу расписания
+    db_manager = get_db_manager()
+    occupied = db_manager.get_occupied_times(date, get_time_matrix())
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Матрица времени по 4 кнопки в строке из готовых кнопок
+    reply_markup = KEYBOARDS.time_keyboard(occupied)
     query.edit_message_text(f"🕐 *Выберите время начала ({date}):*", reply_markup=reply_markup, parse_mode='Markdown')
 
 # Показ выбора продолжительности
-def show_duration_picker(update: Update, context: CallbackContext):
+def show_duration_picker(update: Update, context: CallbackContext, start_time: str):
     query = update.callback_query
     user_id = query.from_user.id
     
-    if user_id not in USER_STATES:
+    session = USER_STATES.get(user_id)
+    if session is None:
         return
     
-    start_time = query.data.split("_", 1)[1]
-    USER_STATES[user_id]['start_time'] = start_time
-    USER_STATES[user_id]['state'] = BookingState.DURATION
+    session.start_time = start_time
+    session.state = BookingState.DURATION
+    USER_STATES.save(session)
     
-    # Создаём кнопки для всех интервалов из конфигурации
-    keyboard = []
-    formatted_intervals = config.get_time_intervals_formatted()
-    
-    # Разбиваем на строки по 2 кнопки
-    for i in range(0, len(formatted_intervals), 2):
-        row_intervals = formatted_intervals[i:i+2]
-        row = []
-        for minutes, text in row_intervals:
-            row.append(InlineKeyboardButton(text, callback_data=f"duration_{minutes}"))
-        keyboard.append(row)
-    
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"date_{USER_STATES[user_id]['date']}")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Скрываем продолжительности, которые заходят на следующее бронирование
+    db_manager = get_db_manager()
+    next_start = db_manager.get_next_booking_start(session.date, start_time)
+    reply_markup = KEYBOARDS.duration_keyboard(session.date, start_time, next_start)
     query.edit_message_text(
         f"⏱️ *Выберите продолжительность бронирования:*\n"
-        f"📅 Дата: {USER_STATES[user_id]['date']}\n"
+        f"📅 Дата: {session.date}\n"
         f"🕐 Начало: {start_time}", 
         reply_markup=reply_markup,
         parse_mode='Markdown'
     )
 
 # Обработка выбора продолжительности
-def handle_duration_selection(update: Update, context: CallbackContext):
+def handle_duration_selection(update: Update, context: CallbackContext, duration: int):
     query = update.callback_query
     user_id = query.from_user.id
     user_name = query.from_user.username or query.from_user.first_name
     
-    if user_id not in USER_STATES:
+    session = USER_STATES.get(user_id)
+    if session is None:
         return
     
-    # Получаем продолжительность в минутах
-    duration = int(query.data.split("_")[1])
-    start_time = USER_STATES[user_id]['start_time']
-    date = USER_STATES[user_id]['date']
+    start_time = session.start_time
+    date = session.date
     
     # Рассчитываем время окончания
     start_dt = datetime.strptime(start_time, "%H:%M")
@@ -328,33 +370,27 @@ def handle_duration_selection(update: Update, context: CallbackContext):
         )
         return
     
-    USER_STATES[user_id]['end_time'] = end_time
+    session.end_time = end_time
     
-    # Проверяем на конфликты и получаем информацию о конфликте
+    # Проверяем конфликт и сохраняем бронирование одной транзакцией
     db_manager = get_db_manager()
-    if db_manager.is_conflict(date, start_time, end_time):
-        conflicting_booking = db_manager.get_conflicting_booking(date, start_time, end_time)
-        if conflicting_booking:
-            conflicting_user, conflicting_start, conflicting_end = conflicting_booking
-            conflict_message = (
-                f"❌ В это время комната уже занята!\n\n"
-                f"📅 Дата: {date}\n"
-                f"🕐 Конфликтное время: {conflicting_start} - {conflicting_end}\n"
-                f"👤 Забронировал: @{conflicting_user}\n\n"
-                "Пожалуйста, выберите другое время."
-            )
-        else:
-            conflict_message = "❌ В это время комната уже занята!\nПожалуйста, выберите другое время."
+    reservation = write_db(db_manager.reserve_slot, user_id, user_name, date, start_time, end_time)
+    if not reservation.success:
+        conflicting_user, conflicting_start, conflicting_end = reservation.conflict
+        conflict_message = (
+            f"❌ В это время комната уже занята!\n\n"
+            f"📅 Дата: {date}\n"
+            f"🕐 Конфликтное время: {conflicting_start} - {conflicting_end}\n"
+            f"👤 Забронировал: @{conflicting_user}\n\n"
+            "Пожалуйста, выберите другое время."
+        )
         
         keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="book_room")]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         query.edit_message_text(conflict_message, reply_markup=reply_markup)
-        del USER_STATES[user_id]
+        USER_STATES.delete(user_id)
         return
     
-    # Сохраняем бронирование
-    db_manager.save_booking(user_id, user_name, date, start_time, end_time)
-    
     # Форматируем продолжительность для отображения
     hours = duration // 60
     minutes = duration % 60
@@ -376,29 +412,110 @@ def handle_duration_selection(update: Update, context: CallbackContext):
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     query.edit_message_text(success_message, reply_markup=reply_markup)
-    del USER_STATES[user_id]
+    USER_STATES.delete(user_id)
 
-# Просмотр расписания
-def show_schedule(update: Update, context: CallbackContext):
-    query = update.callback_query
+# Кнопка возврата в главное меню под сообщениями
+BACK_TO_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]])
+
+# Ключ кэша для списков предстоящих броней: прошедшие брони уходят из списка раз в минуту
+def current_minute():
+    return datetime.now().strftime("%Y-%m-%d %H:%M")
+
+# Страница расписания: direction "after" / "before" - соседняя страница относительно ключа
+def get_schedule_page(direction=None, key=None):
     db_manager = get_db_manager()
-    bookings = db_manager.get_all_bookings()
+    page_size = config.schedule_page_size
     
-    if not bookings:
-        message = "📅 *Нет активных бронирований*"
+    if direction == "before":
+        bookings = db_manager.get_all_bookings(before=key, limit=page_size + 1)
+        has_prev = len(bookings) > page_size
+        bookings = bookings[-page_size:]
+        has_next = True
     else:
-        message = "*📅 Текущие бронирования:*\n\n"
+        bookings = db_manager.get_all_bookings(after=key, limit=page_size + 1)
+        has_next = len(bookings) > page_size
+        bookings = bookings[:page_size]
+        has_prev = key is not None
+    
+    # Соседние брони успели пройти или отмениться - показываем с начала
+    if not bookings and key is not None:
+        return get_schedule_page()
+    return bookings, has_prev, has_next
+
+# Текст и кнопки страницы расписания; берутся из кэша, пока бронирования не изменились
+def render_schedule(direction=None, key=None):
+    def render():
+        bookings, has_prev, has_next = get_schedule_page(direction, key)
+        if not bookings:
+            return "📅 *Нет активных бронирований*", BACK_TO_MENU_MARKUP
+        
+        lines = ["*📅 Текущие бронирования:*", ""]
         current_date = ""
+        for booking in bookings:
+            if booking.date != current_date:
+                current_date = booking.date
+                lines.append(f"📆 *{booking.date}:*")
+            lines.append(f"  🕐 {booking.start_time}-{booking.end_time} (@{booking.user_name})")
+        
+        if not (has_prev or has_next):
+            return "\n".join(lines) + "\n", BACK_TO_MENU_MARKUP
         
-        for date, start_time, end_time, user_name in bookings:
+        # Ключ первой / последней строки - в callback_data кнопок листания
+        navigation = []
+        if has_prev:
+            first = bookings[0]
+            navigation.append(InlineKeyboardButton(
+                "◀️ Раньше", callback_data=f"schedule_before_{first.start_at}_{first.booking_id}"))
+        if has_next:
+            last = bookings[-1]
+            navigation.append(InlineKeyboardButton(
+                "Позже ▶️", callback_data=f"schedule_after_{last.start_at}_{last.booking_id}"))
+        reply_markup = InlineKeyboardMarkup([
+            navigation,
+            [InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]
+        ])
+        return "\n".join(lines) + "\n", reply_markup
+    
+    return get_db_manager().render_cache.get(("schedule", direction, key, current_minute()), render)
+
+# Разбор callback_data кнопок листания: "<after|before>_<YYYY-MM-DD HH:MM>_<id>"
+def parse_schedule_cursor(payload):
+    direction, start_at, booking_id = payload.split("_")
+    if direction not in ("after", "before") or len(start_at) != 16:
+        raise ValueError(f"Invalid schedule cursor: {payload!r}")
+    return direction, (start_at, int(booking_id))
+
+# Текст бронирований пользователя
+def render_user_bookings(user_id, user_name):
+    db_manager = get_db_manager()
+    
+    def render():
+        bookings = db_manager.get_user_bookings(user_id)
+        if not bookings:
+            return "📅 *У вас нет активных бронирований*", BACK_TO_MENU_MARKUP
+        
+        lines = [f"*📅 Ваши бронирования (@{user_name}):*", ""]
+        current_date = ""
+        for date, start_time, end_time in bookings:
             if date != current_date:
                 current_date = date
-                message += f"📆 *{date}:*\n"
-            message += f"  🕐 {start_time}-{end_time} (@{user_name})\n"
-    
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+                lines.append(f"📆 *{date}:*")
+            lines.append(f"  🕐 {start_time}-{end_time}")
+        return "\n".join(lines) + "\n", BACK_TO_MENU_MARKUP
     
+    return db_manager.render_cache.get(("my_bookings", user_id, user_name, current_minute()), render)
+
+# Просмотр расписания
+def show_schedule(update: Update, context: CallbackContext):
+    query = update.callback_query
+    message, reply_markup = render_schedule()
+    query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+
+# Листание расписания
+def show_schedule_page(update: Update, context: CallbackContext, cursor):
+    query = update.callback_query
+    direction, key = cursor
+    message, reply_markup = render_schedule(direction, key)
     query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
 
 # Просмотр моих бронирований
@@ -407,24 +524,7 @@ def show_my_bookings(update: Update, context: CallbackContext):
     user_id = query.from_user.id
     user_name = query.from_user.username or query.from_user.first_name
     
-    db_manager = get_db_manager()
-    bookings = db_manager.get_user_bookings(user_id)
-    
-    if not bookings:
-        message = "📅 *У вас нет активных бронирований*"
-    else:
-        message = f"*📅 Ваши бронирования (@{user_name}):*\n\n"
-        current_date = ""
-        
-        for date, start_time, end_time in bookings:
-            if date != current_date:
-                current_date = date
-                message += f"📆 *{date}:*\n"
-            message += f"  🕐 {start_time}-{end_time}\n"
-    
-    keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+    message, reply_markup = render_user_bookings(user_id, user_name)
     query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
 
 # Отмена моих бронирований
@@ -432,7 +532,7 @@ def cancel_my_bookings(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
     db_manager = get_db_manager();
-    result = db_manager.cancel_user_bookings(user_id)
+    result = write_db(db_manager.cancel_user_bookings, user_id)
     if result:
         message = "✅ *Ваши бронирования успешно отменены*"
     else:
@@ -461,55 +561,24 @@ def book_command(update: Update, context: CallbackContext):
 
 def schedule_command(update: Update, context: CallbackContext):
     """Команда /schedule - быстрый просмотр расписания"""
-    db_manager = get_db_manager()
-    bookings = db_manager.get_all_bookings()
-    
-    if not bookings:
-        update.message.reply_text("📅 *Нет активных бронирований*", parse_mode='Markdown')
-        return
-    
-    message = "*📅 Текущие бронирования:*\n\n"
-    current_date = ""
-    
-    for date, start_time, end_time, user_name in bookings:
-        if date != current_date:
-            current_date = date
-            message += f"📆 *{date}:*\n"
-        message += f"  🕐 {start_time}-{end_time} (@{user_name})\n"
-    
-    update.message.reply_text(message, parse_mode='Markdown')
+    message, reply_markup = render_schedule()
+    update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
 
 def my_bookings_command(update: Update, context: CallbackContext):
     """Команда /mybookings - просмотр моих бронирований"""
     user_id = update.effective_user.id
     user_name = update.effective_user.username or update.effective_user.first_name
     
-    db_manager = get_db_manager()
-    bookings = db_manager.get_user_bookings(user_id)
-    
-    if not bookings:
-        update.message.reply_text("📅 *У вас нет активных бронирований*", parse_mode='Markdown')
-        return
-    
-    message = f"*📅 Ваши бронирования (@{user_name}):*\n\n"
-    current_date = ""
-    
-    for date, start_time, end_time in bookings:
-        if date != current_date:
-            current_date = date
-            message += f"📆 *{date}:*\n"
-        message += f"  🕐 {start_time}-{end_time}\n"
-    
+    message, _ = render_user_bookings(user_id, user_name)
     update.message.reply_text(message, parse_mode='Markdown')
 
-# Функция отображения конкретного рейтинга
-def show_specific_rating(update: Update, context: CallbackContext):
-    query = update.callback_query
-    user_id = query.from_user.id
-    
-    # Определяем тип рейтинга
-    rating_type = query.data.replace("rating_", "")
-    
+RATING_RESULT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Другой период", callback_data="show_rating")],
+    [InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]
+])
+
+# Текст рейтинга за период; кэшируется до изменения статистики или имён пользователей
+def render_rating(rating_type):
     current_date = datetime.now()
     year = current_date.year
     month = current_date.month
@@ -527,46 +596,48 @@ def show_specific_rating(update: Update, context: CallbackContext):
         year_filter = None
         month_filter = None
     
-    # Получаем топы
     db_manager = get_db_manager()
     
-    top_bookings = db_manager.get_top_users_by_bookings(year_filter, month_filter, 3)
-    top_duration = db_manager.get_top_users_by_duration(year_filter, month_filter, 3)
-    
-    # Формируем сообщение БЕЗ форматирования
-    message = f"📊 Рейтинг пользователей {period_text}:\n\n"
-    
-    # Топ по количеству бронирований
-    message += "📈 По количеству бронирований:\n"
-    if top_bookings:
-        for i, (user_id, username, count) in enumerate(top_bookings, 1):
-            medal = ["🥇", "🥈", "🥉"][i-1] if i <= 3 else f"{i}."
-            username = username or f"user_{user_id}"  # Если username None
-            message += f"  {medal} @{username} - {count} брон.\n"
-    else:
-        message += "  Нет данных\n"
-    
-    message += "\n"
-    
-    # Топ по длительности (в часах)
-    message += "⏱️ По длительности бронирования:\n"
-    if top_duration:
-        for i, (user_id, username, minutes) in enumerate(top_duration, 1):
-            hours = minutes // 60
-            mins = minutes % 60
-            duration_text = f"{hours}ч {mins}мин" if hours > 0 else f"{mins}мин"
-            medal = ["🥇", "🥈", "🥉"][i-1] if i <= 3 else f"{i}."
-            username = username or f"user_{user_id}"  # Если username None
-            message += f"  {medal} @{username} - {duration_text}\n"
-    else:
-        message += "  Нет данных\n"
-    
-    keyboard = [
-        [InlineKeyboardButton("📊 Другой период", callback_data="show_rating")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    def render():
+        top_bookings = db_manager.get_top_users_by_bookings(year_filter, month_filter, 3)
+        top_duration = db_manager.get_top_users_by_duration(year_filter, month_filter, 3)
+        
+        # Сообщение БЕЗ форматирования
+        lines = [f"📊 Рейтинг пользователей {period_text}:", ""]
+        
+        # Топ по количеству бронирований
+        lines.append("📈 По количеству бронирований:")
+        if top_bookings:
+            for i, (user_id, username, count) in enumerate(top_bookings, 1):
+                medal = ["🥇", "🥈", "🥉"][i-1] if i <= 3 else f"{i}."
+                username = username or f"user_{user_id}"  # Если username None
+                lines.append(f"  {medal} @{username} - {count} брон.")
+        else:
+            lines.append("  Нет данных")
+        
+        lines.append("")
+        
+        # Топ по длительности (в часах)
+        lines.append("⏱️ По длительности бронирования:")
+        if top_duration:
+            for i, (user_id, username, minutes) in enumerate(top_duration, 1):
+                hours = minutes // 60
+                mins = minutes % 60
+                duration_text = f"{hours}ч {mins}мин" if hours > 0 else f"{mins}мин"
+                medal = ["🥇", "🥈", "🥉"][i-1] if i <= 3 else f"{i}."
+                username = username or f"user_{user_id}"  # Если username None
+                lines.append(f"  {medal} @{username} - {duration_text}")
+        else:
+            lines.append("  Нет данных")
+        
+        return "\n".join(lines) + "\n", RATING_RESULT_MARKUP
     
+    return db_manager.render_cache.get(("rating", rating_type, year_filter, month_filter), render)
+
+# Функция отображения конкретного рейтинга
+def show_specific_rating(update: Update, context: CallbackContext, rating_type: str):
+    query = update.callback_query
+    message, reply_markup = render_rating(rating_type)
     query.edit_message_text(message, reply_markup=reply_markup)  # Без parse_mode
 
 # Функция показа рейтинга
@@ -587,95 +658,116 @@ def cancel_command(update: Update, context: CallbackContext):
     """Команда /cancel - отмена моих бронирований"""
     user_id = update.effective_user.id
     db_manager = get_db_manager()
-    result = db_manager.cancel_user_bookings(user_id)
+    result = write_db(db_manager.cancel_user_bookings, user_id)
     if result:
         update.message.reply_text("✅ *Ваши бронирования успешно отменены*", parse_mode='Markdown')
     else:
         update.message.reply_text("❌ *У вас нет активных бронирований для отмены*", parse_mode='Markdown')
 
 # Обработчик нажатий на кнопки
+# Кнопка занятого времени - отвечаем на запрос один раз, с предупреждением
+def answer_disabled_time(update: Update, context: CallbackContext, time: str):
+    update.callback_query.answer("❌ Это время недоступно", show_alert=True)
+
+# Маршруты кнопок: точные совпадения и префиксы с разбором полезной нагрузки
+ROUTER = CallbackRouter()
+ROUTER.exact("main_menu", start)
+ROUTER.exact("book_room", start_booking)
+ROUTER.exact("show_schedule", show_schedule, concurrent=True)
+ROUTER.exact("my_bookings", show_my_bookings, concurrent=True)
+ROUTER.exact("cancel_my_bookings", cancel_my_bookings)
+ROUTER.exact("help", help_command)
+ROUTER.exact("show_rating", show_rating)
+ROUTER.prefix("schedule", show_schedule_page, parse_schedule_cursor, concurrent=True)
+ROUTER.prefix("date", show_time_picker, parse_date)
+ROUTER.prefix("start", show_duration_picker, parse_time)
+ROUTER.prefix("duration", handle_duration_selection, int)
+ROUTER.prefix("rating", show_specific_rating, parse_choice("month", "year", "all_time"), concurrent=True)
+ROUTER.prefix("disabled", answer_disabled_time, parse_time, answer=False)
+
+# Обработка нажатий кнопок
 def button_handler(update: Update, context: CallbackContext):
-    query = update.callback_query
-    user_id = query.from_user.id
-    
-    query.answer()
-    
-    # Главное меню
-    if query.data == "main_menu":
-        start(update, context)
-        return
-    
-    # Начало бронирования
-    elif query.data == "book_room":
-        start_booking(update, context)
-        return
-    
-    # Просмотр расписания
-    elif query.data == "show_schedule":
-        show_schedule(update, context)
-        return
-    
-    # Мои бронирования
-    elif query.data == "my_bookings":
-        show_my_bookings(update, context)
-        return
-    
-    # Отмена моих бронирований
-    elif query.data == "cancel_my_bookings":
-        cancel_my_bookings(update, context)
-        return
-    
-    # Помощь
-    elif query.data == "help":
-        help_command(update, context)
-        return
-    
-    # Выбор даты
-    elif query.data.startswith("date_"):
-        show_time_picker(update, context)
-        return
-    
-    # Выбор времени начала
-    elif query.data.startswith("start_"):
-        show_duration_picker(update, context)
-        return
-    
-    # Выбор продолжительности
-    elif query.data.startswith("duration_"):
-        handle_duration_selection(update, context)
-        return
+    ROUTER.dispatch(update, context)
+
+class LocalWebhookUpdater(Updater):
+    """Updater, который поднимает webhook-сервер, не регистрируя его в Telegram"""
     
-    # Отключенные кнопки
-    elif query.data.startswith("disabled_"):
-        query.answer("❌ Это время недоступно", show_alert=True)
-        return
-      # Рейтинг
-    elif query.data == "show_rating":
-        show_rating(update, context)
+    def _bootstrap(self, *args, **kwargs):
+        pass
+
+# Приём обновлений в режиме из настроек (updates.mode): polling или webhook
+def start_updates(updater):
+    if config.updates.get('mode', 'polling') != 'webhook':
+        updater.start_polling()
+        print("Получение обновлений: polling")
         return
     
-    elif query.data.startswith("rating_"):
-        show_specific_rating(update, context)
-        return
+    webhook = config.webhook
+    url_path = config.get_webhook_path()
+    if not webhook['secret']:
+        logger.warning("Webhook без секрета: любой, кто знает адрес, может слать боту обновления")
+    
+    webhook_url = None
+    if webhook['public_url']:
+        webhook_url = f"{webhook['public_url'].rstrip('/')}/{url_path}"
+    elif webhook['register']:
+        logger.warning("Не задан webhook.public_url: Telegram не сможет достучаться до локального адреса")
+    
+    updater.start_webhook(
+        listen=webhook['listen'],
+        port=webhook['port'],
+        url_path=url_path,
+        cert=webhook['cert'],
+        key=webhook['key'],
+        webhook_url=webhook_url,
+        drop_pending_updates=webhook['drop_pending_updates'],
+        max_connections=webhook['max_connections']
+    )
+    print(f"Получение обновлений: webhook на {webhook['listen']}:{webhook['port']}/{webhook['path'].strip('/')}/...")
 
 def main():
-    # Инициализируем базу данных
-    init_db_manager(config.database_file)
+    # Инициализируем базу данных и индекс расписания; при включённых уведомлениях
+    # каждое бронирование ставит напоминание в outbox в своей же транзакции
+    reminder_minutes = config.notifications['reminder_minutes'] if config.notifications['enable'] else None
+    db_manager = init_db_manager(config.database_file, reminder_minutes=reminder_minutes)
+    db_manager.schedule.rebuild()
+    db_manager.leaderboards.rebuild()
+    
+    # Сессии в базе переживают перезапуск бота
+    if config.sessions.get('persistent'):
+        global USER_STATES
+        USER_STATES = SQLiteSessionStore(db_manager, ttl=config.sessions.get('ttl_minutes', 30) * 60,
+                                          writer=write_db)
     
     # Проверяем токен
     if config.token == "YOUR_BOT_TOKEN_HERE":
         print("Пожалуйста, укажите токен бота в файле settings.json")
         return
     
-    updater = Updater(config.token, use_context=True)
+    # При webhook.register = false сервер поднимается без регистрации в Telegram (локальная проверка)
+    webhook_mode = config.updates.get('mode', 'polling') == 'webhook'
+    updater_class = LocalWebhookUpdater if webhook_mode and not config.webhook['register'] else Updater
+    # Параллельный режим: читающие обработчики - в пуле потоков, записи - через одну очередь
+    concurrent = config.concurrency.get('enabled', False)
+    updater = updater_class(config.token, use_context=True, workers=config.concurrency.get('workers', 4))
     dp = updater.dispatcher
+    if concurrent:
+        start_write_queue()
+        ROUTER.run_concurrent = True
+    
+    metrics_interval = config.concurrency.get('metrics_interval_minutes', 60)
+    if metrics_interval:
+        updater.job_queue.run_repeating(log_metrics, interval=metrics_interval * 60, first=metrics_interval * 60)
+    
+    # Копия базы от `backup.py restore --hot` подхватывается без перезапуска бота
+    updater.job_queue.run_repeating(apply_incoming_database, interval=INCOMING_DATABASE_CHECK_SECONDS, first=0)
     
     # Обработчики команд
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(CommandHandler("help", help_command))
     dp.add_handler(CommandHandler("book", book_command))
-    dp.add_handler(CommandHandler("schedule", schedule_command))
-    dp.add_handler(CommandHandler("mybookings", my_bookings_command))
+    dp.add_handler(CommandHandler("schedule", schedule_command, run_async=concurrent))
+    dp.add_handler(CommandHandler("mybookings", my_bookings_command, run_async=concurrent))
     dp.add_handler(CommandHandler("cancel", cancel_command))
     
     # Обработчик кнопок
@@ -689,13 +781,21 @@ def main():
     # Запускаем поток уведомлений
     start_notification_thread(updater.bot)
     
+    if config.backups.get('enabled'):
+        start_backup_scheduler()
+    
     try:
-        updater.start_polling()
+        start_updates(updater)
         updater.idle()
     except KeyboardInterrupt:
         print("Остановка бота...")
-        stop_notification_thread_func()
         updater.stop()
+    finally:
+        stop_notification_thread_func()
+        stop_backup_scheduler()
+        log_metrics()
+        stop_write_queue()
+        close_db_manager()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
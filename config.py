@@ -2,6 +2,22 @@ import json
 import os
 from datetime import datetime
 
+# Настройки webhook по умолчанию.
+# public_url - внешний HTTPS-адрес (обычно за обратным прокси), на который Telegram шлёт обновления;
+# register: false - не регистрировать webhook в Telegram (локальная проверка POST-запросами)
+DEFAULT_WEBHOOK = {
+    "listen": "127.0.0.1",
+    "port": 8443,
+    "path": "telegram",
+    "secret": "",
+    "public_url": "",
+    "cert": None,
+    "key": None,
+    "max_connections": 40,
+    "drop_pending_updates": False,
+    "register": True
+}
+
 class Config:
     def __init__(self, config_file='settings.json'):
         self.config_file = config_file
@@ -15,9 +31,14 @@ class Config:
         with open(self.config_file, 'r', encoding='utf-8') as f:
             config = json.load(f)
         
+        # Номер загрузки: кэши, построенные по настройкам, сравнивают его со своим
+        self.version = getattr(self, 'version', 0) + 1
+        
         self.token = config.get('token', 'YOUR_BOT_TOKEN_HERE')
         self.working_hours = config.get('working_hours', {'start': '08:00', 'end': '20:00'})
         self.booking_range_days = config.get('booking_range_days', 14)
+        # Бронирований на одной странице расписания (сообщение Telegram - до 4096 символов)
+        self.schedule_page_size = config.get('schedule_page_size', 15)
         self.time_intervals = config.get('time_intervals', [15, 30, 45, 60, 75, 90, 105, 120, 150, 180, 210, 240])
         self.database_file = config.get('database_file', 'meeting_room.db')
         
@@ -27,6 +48,34 @@ class Config:
             'reminder_minutes': 15,
             'reminder_message': '⏰ Напоминание: Ваша бронь переговорной комнаты начинается через {minutes} минут!\n\n📅 Дата: {date}\n🕐 Время: {start_time} - {end_time}\n📍 Место: Переговорная комната'
         })
+        
+        # Сессии незавершённых бронирований
+        self.sessions = config.get('sessions', {
+            'ttl_minutes': 30,
+            'persistent': False
+        })
+        
+        # Параллельная обработка обновлений
+        self.concurrency = config.get('concurrency', {
+            'enabled': False,
+            'workers': 4,
+            'write_queue_size': 100,
+            'metrics_interval_minutes': 60
+        })
+        
+        # Плановые бекапы из процесса бота (см. backup_scheduler.py)
+        self.backups = config.get('backups', {
+            'enabled': False,
+            'directory': 'backups',
+            'interval_minutes': 60,
+            'incremental': True,
+            'full_every': 24,
+            'retention': {'hourly': 24, 'daily': 30, 'monthly': None}
+        })
+        
+        # Получение обновлений: polling или webhook
+        self.updates = config.get('updates', {'mode': 'polling'})
+        self.webhook = dict(DEFAULT_WEBHOOK, **self.updates.get('webhook', {}))
     
     def create_default_config(self):
         """Создаёт файл конфигурации по умолчанию"""
@@ -37,12 +86,40 @@ class Config:
                 "end": "20:00"
             },
             "booking_range_days": 14,
+            "schedule_page_size": 15,
             "time_intervals": [15, 30, 45, 60, 75, 90, 105, 120, 150, 180, 210, 240],
             "database_file": "meeting_room.db",
             "notifications": {
                 "enable": True,
                 "reminder_minutes": 15,
-                "reminder_message": "⏰ Напоминание: Ваша бронь переговорной комнаты начинается через {minutes} минут!\n\n📅 Дата: {date}\n🕐 Время: {start_time} - {end_time}\n📍 Место: Переговорная комната"
+                "reminder_message": "⏰ Напоминание: Ваша бронь переговорной комнаты начинается через {minutes} минут!\n\n📅 Дата: {date}\n🕐 Время: {start_time} - {end_time}\n📍 Место: Переговорная комната",
+                "senders": 4,
+                "global_rate_per_second": 30,
+                "per_chat_rate_per_second": 1,
+                "max_attempts": 3,
+                "outbox_max_attempts": 5
+            },
+            "sessions": {
+                "ttl_minutes": 30,
+                "persistent": False
+            },
+            "concurrency": {
+                "enabled": False,
+                "workers": 4,
+                "write_queue_size": 100,
+                "metrics_interval_minutes": 60
+            },
+            "backups": {
+                "enabled": False,
+                "directory": "backups",
+                "interval_minutes": 60,
+                "incremental": True,
+                "full_every": 24,
+                "retention": {"hourly": 24, "daily": 30, "monthly": None}
+            },
+            "updates": {
+                "mode": "polling",
+                "webhook": dict(DEFAULT_WEBHOOK)
             }
         }
         
@@ -60,6 +137,11 @@ class Config:
         """Возвращает время окончания рабочего дня как объект time"""
         return datetime.strptime(self.working_hours['end'], '%H:%M').time()
     
+    def get_webhook_path(self):
+        """Путь webhook; секрет - часть пути, запросы на другие адреса сервер отклоняет"""
+        parts = [self.webhook['path'].strip('/'), self.webhook['secret'].strip('/')]
+        return '/'.join(part for part in parts if part)
+    
     def get_time_intervals_formatted(self):
         """Возвращает отформатированный список интервалов"""
         formatted_intervals = []
@@ -1,85 +1,364 @@
+import os
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, NamedTuple, Set
+
+from migrations import migrate
+from schedule_index import ScheduleIndex, read_bookings_version, read_data_version
+from leaderboard import Leaderboards, StatsDelta
+from render_cache import RenderCache
+
+class ConnectionPool:
+    """Ограниченный пул долгоживущих соединений с базой данных"""
+    
+    def __init__(self, factory, max_size: int = 5, timeout: float = 30.0):
+        self._factory = factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []  # (соединение, поколение); берём последнее вернувшееся
+        self._size = 0
+        self._generation = 0
+        self._closed = False
+        self._paused = False  # drain(): новые соединения не выдаются до resume()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+    
+    @contextmanager
+    def connection(self):
+        """Выдача соединения на время блока (повторный вход в том же потоке отдаёт то же соединение)"""
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            yield held
+            return
+        
+        conn, generation = self._checkout()
+        self._local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            self._checkin(conn, generation)
+    
+    def _checkout(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                if not self._paused:
+                    if self._idle:
+                        return self._idle.pop()
+                    if self._size < self.max_size:
+                        self._size += 1
+                        generation = self._generation
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("Timed out waiting for a database connection")
+                self._cond.wait(remaining)
+        
+        # Соединение открываем вне блокировки, чтобы не задерживать другие потоки
+        try:
+            return self._factory(), generation
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify_all()
+            raise
+    
+    def _checkin(self, conn, generation: int):
+        with self._cond:
+            if self._closed or generation != self._generation:
+                self._size -= 1
+                conn.close()
+            else:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.append((conn, generation))
+            # На условии ждут и выдача, и drain(): при одном notify() его мог забрать
+            # приостановленный _checkout, и drain() досиживал бы весь timeout
+            self._cond.notify_all()
+    
+    def reset(self):
+        """Закрытие простаивающих соединений; выданные закроются при возврате"""
+        with self._cond:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _ in idle:
+            conn.close()
+    
+    def drain(self, timeout: float = 30.0):
+        """Приостановка выдачи и закрытие всех соединений; выданные дожидаемся до timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._paused = True
+        self.reset()
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._size == 0, deadline - time.monotonic()):
+                self._paused = False
+                self._cond.notify_all()
+                raise TimeoutError("Timed out draining database connections")
+    
+    def resume(self):
+        """Возобновление выдачи соединений после drain()"""
+        with self._cond:
+            self._paused = False
+            self._cond.notify_all()
+    
+    def close(self):
+        """Закрытие пула и всех простаивающих соединений"""
+        with self._cond:
+            self._closed = True
+        self.reset()
+    
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+# Сортируемый формат даты и времени для колонок start_at / end_at
+SORTABLE_FORMAT = "%Y-%m-%d %H:%M"
+
+# Формат момента отправки в outbox (с секундами - для пауз между повторами)
+OUTBOX_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Сколько захваченное напоминание считается отправляемым; потом его можно захватить снова
+REMINDER_LEASE_SECONDS = 300
+
+def _chunks(items: List, size: int = 500):
+    """Пачки по size элементов, чтобы не упереться в лимит параметров SQLite"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Агрегация статистики по бронированиям: год и месяц из start_at, длительность из HH:MM
+_STATS_AGGREGATE_SQL = """
+    INSERT INTO stats (user_id, year, month, total_bookings, total_duration_minutes)
+    SELECT user_id,
+           CAST(substr(start_at, 1, 4) AS INTEGER),
+           CAST(substr(start_at, 6, 2) AS INTEGER),
+           COUNT(*),
+           SUM((CAST(substr(end_time, 1, 2) AS INTEGER) * 60 + CAST(substr(end_time, 4, 2) AS INTEGER))
+               - (CAST(substr(start_time, 1, 2) AS INTEGER) * 60 + CAST(substr(start_time, 4, 2) AS INTEGER)))
+    FROM bookings
+    WHERE {where}
+    GROUP BY user_id, substr(start_at, 1, 7)
+"""
+
+# Вклад предстоящих бронирований пользователя в stats по месяцам (те же выражения, что и при пересчёте)
+_STATS_DELTA_SQL = """
+    SELECT CAST(substr(start_at, 1, 4) AS INTEGER),
+           CAST(substr(start_at, 6, 2) AS INTEGER),
+           COUNT(*),
+           SUM((CAST(substr(end_time, 1, 2) AS INTEGER) * 60 + CAST(substr(end_time, 4, 2) AS INTEGER))
+               - (CAST(substr(start_time, 1, 2) AS INTEGER) * 60 + CAST(substr(start_time, 4, 2) AS INTEGER)))
+    FROM bookings
+    WHERE user_id = ? AND start_at >= ?
+    GROUP BY substr(start_at, 1, 7)
+"""
+
+def _next_month(month: str) -> str:
+    """'YYYY-MM' -> следующий месяц в том же формате"""
+    year, month_number = map(int, month.split("-"))
+    if month_number == 12:
+        return f"{year + 1}-01"
+    return f"{year}-{month_number + 1:02d}"
+
+class ReservationResult(NamedTuple):
+    """Результат попытки бронирования"""
+    booking_id: Optional[int]
+    conflict: Optional[Tuple] = None  # (user_name, start_time, end_time) конфликтующей брони
+    
+    @property
+    def success(self) -> bool:
+        return self.booking_id is not None
+
+class ScheduleEntry(NamedTuple):
+    """Строка расписания; key - ключ для постраничной выборки"""
+    date: str
+    start_time: str
+    end_time: str
+    user_name: str
+    booking_id: int
+    start_at: str
+    
+    @property
+    def key(self) -> Tuple[str, int]:
+        return (self.start_at, self.booking_id)
 
 class DatabaseManager:
-    def __init__(self, db_file: str):
+    def __init__(self, db_file: str, pool_size: int = 5, auto_migrate: bool = True, reminder_minutes: int = None):
         self.db_file = db_file
-        self.init_db()
+        # Если задано - каждое бронирование ставит напоминание в outbox
+        self.reminder_minutes = reminder_minutes
+        self.pool = ConnectionPool(self.get_connection, max_size=pool_size)
+        self.schedule = ScheduleIndex(self)
+        self.render_cache = RenderCache(self)
+        self.leaderboards = Leaderboards(self)
+        self._listeners = []
+        if auto_migrate:
+            self.init_db()
     
     def get_connection(self):
-        """Получение соединения с базой данных"""
-        return sqlite3.connect(self.db_file)
+        """Открытие нового соединения с базой данных"""
+        # isolation_level=None: транзакции открываются явно в transaction()
+        conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False, isolation_level=None)
+        return conn
     
-    def init_db(self):
-        """Инициализация базы данных"""
-        conn = self.get_connection()
-        c = conn.cursor()
+    @contextmanager
+    def connection(self):
+        """Соединение из пула для чтения"""
+        with self.pool.connection() as conn:
+            yield conn
+    
+    @contextmanager
+    def transaction(self, immediate: bool = False):
+        """Выполнение блока в одной транзакции (вложенные вызовы используют внешнюю)"""
+        with self.pool.connection() as conn:
+            if conn.in_transaction:
+                yield conn
+                return
+            
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+    
+    def add_listener(self, listener) -> None:
+        """Подписка на изменения данных: listener(event, **data)"""
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+    
+    def remove_listener(self, listener) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+    
+    def _emit(self, event: str, **data) -> None:
+        """Оповещение подписчиков после успешного коммита"""
+        for listener in list(self._listeners):
+            try:
+                listener(event, **data)
+            except Exception as e:
+                print(f"Ошибка обработчика события {event}: {e}")
+    
+    def replace_database(self, new_file: str, timeout: float = 30.0) -> float:
+        """Горячая замена файла базы проверенной копией new_file; возвращает длительность, с.
         
-        # Таблица бронирований
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS bookings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                user_name TEXT,
-                date TEXT,
-                start_time TEXT,
-                end_time TEXT,
-                notified BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        Копия заранее переводится в WAL и догоняет миграции через своё соединение.
+        Затем кэши блокируются, пул дожидается возврата выданных соединений и закрывает все,
+        после чего new_file атомарно переименовывается в db_file. Запросы на время
+        замены ждут в пуле и продолжают работу уже с новой базой.
+        """
+        # На живой базе смена режима журнала и миграции конкурировали бы с запросами
+        prepared = DatabaseManager(new_file, pool_size=1)
+        prepared.close()
         
-        # Таблица для отслеживания пользователей
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        started = time.monotonic()
+        try:
+            with self.schedule.suspended(), self.leaderboards.suspended(), self.render_cache.suspended():
+                self.pool.drain(timeout)
+                try:
+                    # После закрытия последнего соединения -wal старой базы удаляется; если он
+                    # остался, базу держит другой процесс, и новая база смешалась бы с его журналом
+                    if os.path.exists(self.db_file + "-wal"):
+                        raise RuntimeError("Database is open in another process")
+                    os.replace(new_file, self.db_file)
+                finally:
+                    self.pool.resume()
+        finally:
+            # Кэши пусты после suspended() - загружаем их и при неудачной замене
+            self.schedule.rebuild()
+            self.leaderboards.rebuild()
+        elapsed = time.monotonic() - started
+        self._emit("database_replaced", db_file=self.db_file)
+        return elapsed
+    
+    def close(self):
+        """Закрытие всех соединений с базой данных"""
+        self.schedule.close()
+        self.render_cache.close()
+        self.leaderboards.close()
+        self.pool.close()
+    
+    def init_db(self):
+        """Инициализация базы данных (режим журнала и применение недостающих миграций)"""
+        with self.connection() as conn:
+            # WAL: читатели (в том числе онлайн-бекап) не блокируют запись, и наоборот
+            conn.execute("PRAGMA journal_mode=WAL")
+        migrate(self)
+    
+    def save_booking(self, user_id: int, user_name: str, date: str, start_time: str, end_time: str) -> int:
+        """Сохранение бронирования и возвращение ID"""
+        with self.transaction() as conn:
+            stats_before = read_data_version(conn, 'stats')
+            booking_id, stats_delta = self._insert_booking(conn, user_id, user_name, date, start_time, end_time)
+            version = read_bookings_version(conn)
+            stats_after = read_data_version(conn, 'stats')
         
-        # Таблица для хранения статистики
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                year INTEGER,
-                month INTEGER,
-                total_bookings INTEGER DEFAULT 0,
-                total_duration_minutes INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        self.schedule.add(version, booking_id, user_id, user_name, date, start_time, end_time)
+        self.leaderboards.apply_stats(stats_before, stats_after, stats_delta)
+        self._emit("booking_added", booking_id=booking_id, user_id=user_id, user_name=user_name,
+                   date=date, start_time=start_time, end_time=end_time)
+        return booking_id
+    
+    def reserve_slot(self, user_id: int, user_name: str, date: str, start_time: str, end_time: str) -> ReservationResult:
+        """Атомарная проверка пересечения и сохранение бронирования"""
+        # Заведомый конфликт отсекаем по индексу в памяти, не занимая блокировку записи
+        conflict = self.schedule.find_conflict(date, start_time, end_time)
+        if conflict is not None:
+            return ReservationResult(None, conflict)
         
-        # Индексы для улучшения производительности
-        c.execute('CREATE INDEX IF NOT EXISTS idx_bookings_date ON bookings(date)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_bookings_user_id ON bookings(user_id)')
-        c.execute('CREATE INDEX IF NOT EXISTS idx_stats_user_year_month ON stats(user_id, year, month)')
+        # BEGIN IMMEDIATE сразу берёт блокировку записи: два параллельных
+        # бронирования одного слота не могут оба пройти проверку
+        with self.transaction(immediate=True) as conn:
+            conflict = self._find_conflict(conn, date, start_time, end_time)
+            if conflict is not None:
+                return ReservationResult(None, conflict)
+            
+            stats_before = read_data_version(conn, 'stats')
+            booking_id, stats_delta = self._insert_booking(conn, user_id, user_name, date, start_time, end_time)
+            version = read_bookings_version(conn)
+            stats_after = read_data_version(conn, 'stats')
         
-        conn.commit()
-        conn.close()
+        self.schedule.add(version, booking_id, user_id, user_name, date, start_time, end_time)
+        self.leaderboards.apply_stats(stats_before, stats_after, stats_delta)
+        self._emit("booking_added", booking_id=booking_id, user_id=user_id, user_name=user_name,
+                   date=date, start_time=start_time, end_time=end_time)
+        return ReservationResult(booking_id)
     
-    def save_booking(self, user_id: int, user_name: str, date: str, start_time: str, end_time: str) -> int:
-        """Сохранение бронирования и возвращение ID"""
-        conn = self.get_connection()
+    def _insert_booking(self, conn, user_id: int, user_name: str, date: str, start_time: str,
+                        end_time: str) -> Tuple[int, List[StatsDelta]]:
+        """Вставка бронирования и обновление статистики в текущей транзакции;
+        возвращает ID бронирования и внесённые в stats изменения"""
         cursor = conn.cursor()
         cursor.execute("""
             INSERT INTO bookings (user_id, user_name, date, start_time, end_time)
             VALUES (?, ?, ?, ?, ?)
         """, (user_id, user_name, date, start_time, end_time))
         booking_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
         
-        # Обновляем статистику
-        self._update_user_stats(user_id, date, start_time, end_time)
-        return booking_id
+        stats_delta = self._update_user_stats(conn, user_id, date, start_time, end_time)
+        self._enqueue_reminder(conn, booking_id)
+        return booking_id, stats_delta
     
-    def _update_user_stats(self, user_id: int, date: str, start_time: str, end_time: str):
+    def _find_conflict(self, conn, date: str, start_time: str, end_time: str) -> Optional[Tuple]:
+        """Поиск первого бронирования, пересекающегося с интервалом"""
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT user_name, start_time, end_time FROM bookings 
+            WHERE date = ? AND 
+                  (start_time < ? AND end_time > ?)
+            ORDER BY start_time
+            LIMIT 1
+        """, (date, end_time, start_time))
+        return cursor.fetchone()
+    
+    def _update_user_stats(self, conn, user_id: int, date: str, start_time: str, end_time: str) -> List[StatsDelta]:
         """Обновление статистики пользователя"""
         try:
             # Рассчитываем длительность в минутах
@@ -92,319 +371,363 @@ class DatabaseManager:
             year = booking_date.year
             month = booking_date.month
             
-            conn = self.get_connection()
+            # Одна инструкция: уникальный ключ (user_id, year, month) исключает дубли месяца
             cursor = conn.cursor()
-            
-            # Проверяем, есть ли уже запись для этого пользователя и месяца
             cursor.execute("""
-                SELECT total_bookings, total_duration_minutes 
-                FROM stats 
-                WHERE user_id = ? AND year = ? AND month = ?
-            """, (user_id, year, month))
+                INSERT INTO stats (user_id, year, month, total_bookings, total_duration_minutes)
+                VALUES (?, ?, ?, 1, ?)
+                ON CONFLICT (user_id, year, month) DO UPDATE SET
+                    total_bookings = total_bookings + 1,
+                    total_duration_minutes = total_duration_minutes + excluded.total_duration_minutes,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (user_id, year, month, duration_minutes))
+            return [(user_id, year, month, 1, duration_minutes)]
+        except Exception as e:
+            print(f"Ошибка обновления статистики: {e}")
+            return []
+    
+    def rebuild_stats(self, incremental: bool = False) -> int:
+        """Пересчёт статистики из bookings одной транзакцией; возвращает число строк stats"""
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
             
-            result = cursor.fetchone()
+            cursor.execute("SELECT value FROM meta WHERE key = 'stats_rebuilt_booking_id'")
+            row = cursor.fetchone()
             
-            if result:
-                # Обновляем существующую запись
-                total_bookings = result[0] + 1
-                total_duration = result[1] + duration_minutes
+            if incremental and row is not None:
+                # Пересчитываем только месяцы, в которых появились бронирования после прошлого пересчёта
                 cursor.execute("""
-                    UPDATE stats 
-                    SET total_bookings = ?, total_duration_minutes = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ? AND year = ? AND month = ?
-                """, (total_bookings, total_duration, user_id, year, month))
+                    SELECT DISTINCT substr(start_at, 1, 7) FROM bookings
+                    WHERE id > ? AND start_at IS NOT NULL
+                """, (int(row[0]),))
+                months = [month for (month,) in cursor.fetchall()]
+                for month in months:
+                    year, month_number = map(int, month.split("-"))
+                    cursor.execute("DELETE FROM stats WHERE year = ? AND month = ?", (year, month_number))
+                ranges = [(month, _next_month(month)) for month in months]
             else:
-                # Создаем новую запись
-                cursor.execute("""
-                    INSERT INTO stats (user_id, year, month, total_bookings, total_duration_minutes)
-                    VALUES (?, ?, ?, 1, ?)
-                """, (user_id, year, month, duration_minutes))
+                cursor.execute("DELETE FROM stats")
+                ranges = [None]
             
-            conn.commit()
-            conn.close()
-        except Exception as e:
-            print(f"Ошибка обновления статистики: {e}")
+            written = 0
+            for month_range in ranges:
+                if month_range is None:
+                    where, params = "start_at IS NOT NULL", ()
+                else:
+                    where, params = "start_at >= ? AND start_at < ?", month_range
+                cursor.execute(_STATS_AGGREGATE_SQL.format(where=where), params)
+                written += cursor.rowcount
+            
+            cursor.execute("""
+                INSERT OR REPLACE INTO meta (key, value)
+                SELECT 'stats_rebuilt_booking_id', COALESCE(MAX(id), 0) FROM bookings
+            """)
+        
+        self.leaderboards.invalidate()
+        return written
     
     def save_user(self, user_id: int, username: str, first_name: str, last_name: str = None) -> None:
         """Сохранение информации о пользователе"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT OR REPLACE INTO users (user_id, username, first_name, last_name)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, username, first_name, last_name))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            users_before = read_data_version(conn, 'users')
+            # Строка меняется, только если данные действительно другие:
+            # повторный /start не сбрасывает кэши, зависящие от версии users
+            cursor.execute("""
+                INSERT INTO users (user_id, username, first_name, last_name)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name
+                WHERE username IS NOT excluded.username
+                   OR first_name IS NOT excluded.first_name
+                   OR last_name IS NOT excluded.last_name
+            """, (user_id, username, first_name, last_name))
+            changed = cursor.rowcount > 0
+            users_after = read_data_version(conn, 'users')
+        
+        if changed:
+            self.leaderboards.apply_user(users_before, users_after, user_id, username)
     
     def get_all_users(self) -> List[Tuple]:
         """Получение всех пользователей (кроме текущего)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT user_id, username, first_name FROM users")
-        users = cursor.fetchall()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, username, first_name FROM users")
+            users = cursor.fetchall()
         return users
     
     def is_conflict(self, date: str, start_time: str, end_time: str) -> bool:
         """Проверка на пересечение бронирований"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT * FROM bookings 
-            WHERE date = ? AND 
-                  (start_time < ? AND end_time > ?)
-        """, (date, end_time, start_time))
-        result = cursor.fetchone()
-        conn.close()
-        return result is not None
+        return not self.schedule.is_free(date, start_time, end_time)
     
     def get_conflicting_booking(self, date: str, start_time: str, end_time: str) -> Optional[Tuple]:
         """Получение информации о конфликтующем бронировании"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT user_name, start_time, end_time FROM bookings 
-            WHERE date = ? AND 
-                  (start_time < ? AND end_time > ?)
-        """, (date, end_time, start_time))
-        result = cursor.fetchone()
-        conn.close()
-        return result
+        return self.schedule.find_conflict(date, start_time, end_time)
     
-    def get_all_bookings(self) -> List[Tuple]:
-        """Получение всех активных бронирований (только будущие)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_occupied_times(self, date: str, times: List[str]) -> Set[str]:
+        """Занятые моменты времени из списка (для сетки выбора начала)"""
+        return self.schedule.occupied_times(date, times)
+    
+    def get_next_booking_start(self, date: str, time_str: str) -> Optional[str]:
+        """Начало ближайшего бронирования после указанного времени"""
+        return self.schedule.next_start_after(date, time_str)
+    
+    def get_free_gaps(self, date: str, day_start: str, day_end: str) -> List[Tuple[str, str]]:
+        """Свободные промежутки дня в пределах рабочего времени"""
+        return self.schedule.free_gaps(date, day_start, day_end)
+    
+    def get_all_bookings(self, after: Tuple[str, int] = None, before: Tuple[str, int] = None,
+                         limit: int = None) -> List[ScheduleEntry]:
+        """Получение активных бронирований (только будущие).
         
-        # Получаем все бронирования
-        cursor.execute("""
-            SELECT date, start_time, end_time, user_name 
-            FROM bookings 
-            ORDER BY date, start_time
-        """)
-        all_bookings = cursor.fetchall()
-        conn.close()
+        after / before - ключ (start_at, id) соседней страницы: выборка идёт по индексу
+        от этого ключа, не пролистывая предыдущие строки.
+        """
+        now = datetime.now().strftime(SORTABLE_FORMAT)
+        conditions = ["start_at >= ?"]
+        params = [now]
+        if after is not None:
+            conditions.append("(start_at, id) > (?, ?)")
+            params.extend(after)
+        if before is not None:
+            conditions.append("(start_at, id) < (?, ?)")
+            params.extend(before)
         
-        # Фильтруем только будущие бронирования (с учетом даты и времени)
-        filtered_bookings = []
-        now = datetime.now()
-        current_date_numeric = now.strftime("%Y%m%d")
-        current_time = now.strftime("%H:%M")
+        # Страница перед ключом читается в обратном порядке и разворачивается
+        order = "DESC" if before is not None and after is None else "ASC"
+        query = f"""
+            SELECT date, start_time, end_time, user_name, id, start_at
+            FROM bookings
+            WHERE {' AND '.join(conditions)}
+            ORDER BY start_at {order}, id {order}
+        """
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
         
-        for date, start_time, end_time, user_name in all_bookings:
-            try:
-                # Преобразуем дату из формата DD.MM.YYYY в YYYYMMDD
-                booking_date = datetime.strptime(date, "%d.%m.%Y")
-                booking_date_numeric = booking_date.strftime("%Y%m%d")
-                
-                # Если дата больше текущей - добавляем
-                if booking_date_numeric > current_date_numeric:
-                    filtered_bookings.append((date, start_time, end_time, user_name))
-                # Если дата равна текущей - проверяем время
-                elif booking_date_numeric == current_date_numeric:
-                    # Сравниваем время начала с текущим временем
-                    if start_time >= current_time:
-                        filtered_bookings.append((date, start_time, end_time, user_name))
-            except ValueError:
-                # Если формат даты некорректный, пропускаем
-                continue
-        
-        return filtered_bookings
+        with self.connection() as conn:
+            bookings = [ScheduleEntry(*row) for row in conn.execute(query, params)]
+        if order == "DESC":
+            bookings.reverse()
+        return bookings
     
     def get_user_bookings(self, user_id: int) -> List[Tuple]:
         """Получение бронирований пользователя (только будущие)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Получаем все бронирования пользователя
-        cursor.execute("""
-            SELECT date, start_time, end_time 
-            FROM bookings 
-            WHERE user_id = ? 
-            ORDER BY date, start_time
-        """, (user_id,))
-        all_bookings = cursor.fetchall()
-        conn.close()
-        
-        # Фильтруем только будущие бронирования (с учетом даты и времени)
-        filtered_bookings = []
+        now = datetime.now().strftime(SORTABLE_FORMAT)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT date, start_time, end_time 
+                FROM bookings 
+                WHERE user_id = ? AND start_at >= ?
+                ORDER BY start_at
+            """, (user_id, now))
+            bookings = cursor.fetchall()
+        return bookings
+    
+    def cancel_user_bookings(self, user_id: int) -> bool:
+        """Отмена предстоящих бронирований пользователя; прошедшие остаются в истории и рейтингах"""
         now = datetime.now()
-        current_date_numeric = now.strftime("%Y%m%d")
-        current_time = now.strftime("%H:%M")
-        
-        for date, start_time, end_time in all_bookings:
-            try:
-                # Преобразуем дату из формата DD.MM.YYYY в YYYYMMDD
-                booking_date = datetime.strptime(date, "%d.%m.%Y")
-                booking_date_numeric = booking_date.strftime("%Y%m%d")
-                
-                # Если дата больше текущей - добавляем
-                if booking_date_numeric > current_date_numeric:
-                    filtered_bookings.append((date, start_time, end_time))
-                # Если дата равна текущей - проверяем время
-                elif booking_date_numeric == current_date_numeric:
-                    # Сравниваем время начала с текущим временем
-                    if start_time >= current_time:
-                        filtered_bookings.append((date, start_time, end_time))
-            except ValueError:
-                # Если формат даты некорректный, пропускаем
-                continue
+        since = now.strftime(SORTABLE_FORMAT)
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                DELETE FROM outbox
+                WHERE booking_id IN (SELECT id FROM bookings WHERE user_id = ? AND start_at >= ?)
+                  AND status != 'sent'
+            """, (user_id, since))
+            stats_before = read_data_version(conn, 'stats')
+            stats_delta = self._remove_user_stats(conn, user_id, since)
+            cursor.execute("DELETE FROM bookings WHERE user_id = ? AND start_at >= ?", (user_id, since))
+            deleted_count = cursor.rowcount
+            version = read_bookings_version(conn)
+            stats_after = read_data_version(conn, 'stats')
         
-        return filtered_bookings
+        self.schedule.remove_user(version, user_id, now)
+        self.leaderboards.apply_stats(stats_before, stats_after, stats_delta)
+        if deleted_count:
+            self._emit("bookings_cancelled", user_id=user_id)
+        return deleted_count > 0
     
-    def cancel_user_bookings(self, user_id: int) -> bool:
-        """Отмена бронирований пользователя"""
-        conn = self.get_connection()
+    def _remove_user_stats(self, conn, user_id: int, since: str) -> List[StatsDelta]:
+        """Вычитание из stats отменяемых бронирований пользователя, начинающихся не раньше since"""
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM bookings WHERE user_id = ?", (user_id,))
-        deleted_count = cursor.rowcount
-        conn.commit()
-        conn.close()
-        return deleted_count > 0
+        cursor.execute(_STATS_DELTA_SQL, (user_id, since))
+        deltas = [(user_id, year, month, -count, -minutes) for year, month, count, minutes in cursor.fetchall()]
+        for _, year, month, count, minutes in deltas:
+            cursor.execute("""
+                UPDATE stats
+                SET total_bookings = total_bookings + ?,
+                    total_duration_minutes = total_duration_minutes + ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ? AND year = ? AND month = ?
+            """, (count, minutes, user_id, year, month))
+        cursor.execute("DELETE FROM stats WHERE user_id = ? AND total_bookings <= 0", (user_id,))
+        return deltas
     
     def get_bookings_for_notification(self, reminder_minutes: int) -> List[Tuple]:
         """Получение бронирований для уведомления"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         now = datetime.now()
         reminder_time = now + timedelta(minutes=reminder_minutes)
         
-        current_date = now.strftime("%d.%m.%Y")
-        reminder_date = reminder_time.strftime("%d.%m.%Y")
-        current_time = now.strftime("%H:%M")
-        reminder_time_str = reminder_time.strftime("%H:%M")
-        
-        # Фильтруем в SQL, но с учетом формата даты
-        cursor.execute("""
-            SELECT id, user_id, user_name, date, start_time, end_time 
-            FROM bookings 
-            WHERE (
-                (date = ? AND start_time >= ? AND start_time <= ?) OR
-                (date = ? AND start_time <= ?)
-            ) 
-            AND notified = FALSE
-        """, (current_date, current_time, reminder_time_str, reminder_date, reminder_time_str))
-        
-        bookings = cursor.fetchall()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, user_id, user_name, date, start_time, end_time 
+                FROM bookings 
+                WHERE start_at >= ? AND start_at <= ?
+                AND notified = FALSE
+            """, (now.strftime(SORTABLE_FORMAT), reminder_time.strftime(SORTABLE_FORMAT)))
+            
+            bookings = cursor.fetchall()
         return bookings
     
     def mark_as_notified(self, booking_id: int) -> None:
         """Отметить бронирование как уведомленное"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE bookings SET notified = TRUE WHERE id = ?", (booking_id,))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE bookings SET notified = TRUE WHERE id = ?", (booking_id,))
     
-    def get_top_users_by_bookings(self, year: int = None, month: int = None, limit: int = 3) -> List[Tuple]:
-        """Получение топ пользователей по количеству бронирований"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def sync_outbox(self) -> int:
+        """Постановка в очередь напоминаний для предстоящих бронирований, которых в ней нет"""
+        if self.reminder_minutes is None:
+            return 0
+        now = datetime.now().strftime(SORTABLE_FORMAT)
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT OR IGNORE INTO outbox (booking_id, due_at)
+                SELECT b.id, strftime(?, b.start_at, ?)
+                FROM bookings b
+                WHERE b.start_at >= ? AND b.notified = FALSE
+                  AND NOT EXISTS (SELECT 1 FROM outbox o WHERE o.booking_id = b.id)
+            """, (OUTBOX_FORMAT, f"-{int(self.reminder_minutes)} minutes", now))
+            return cursor.rowcount
     
-        print(f"DEBUG: get_top_users_by_bookings called with year={year}, month={month}, limit={limit}")  # Отладка
+    def _enqueue_reminder(self, conn, booking_id: int) -> None:
+        """Постановка напоминания в очередь в текущей транзакции бронирования"""
+        if self.reminder_minutes is None:
+            return
+        conn.execute("""
+            INSERT OR IGNORE INTO outbox (booking_id, due_at)
+            SELECT id, strftime(?, start_at, ?) FROM bookings
+            WHERE id = ? AND start_at IS NOT NULL
+        """, (OUTBOX_FORMAT, f"-{int(self.reminder_minutes)} minutes", booking_id))
     
-        if year is not None and month is not None:
-            # Топ за конкретный месяц
-            print(f"DEBUG: Запрос за конкретный месяц: {year}-{month:02d}")
-            cursor.execute("""
-                SELECT s.user_id, u.username, s.total_bookings
-                FROM stats s
-                LEFT JOIN users u ON s.user_id = u.user_id
-                WHERE s.year = ? AND s.month = ?
-                ORDER BY s.total_bookings DESC
-                LIMIT ?
-            """, (year, month, limit))
-        elif year is not None:
-            # Топ за конкретный год
-            print(f"DEBUG: Запрос за конкретный год: {year}")
+    def release_expired_reminders(self, lease_seconds: int = REMINDER_LEASE_SECONDS) -> int:
+        """Возврат в очередь захваченных, но не подтверждённых напоминаний с истёкшей арендой.
+        
+        Процесс упал между отправкой и подтверждением - доставка "хотя бы один раз".
+        """
+        lease_expired = (datetime.now() - timedelta(seconds=lease_seconds)).strftime(OUTBOX_FORMAT)
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.execute("""
+                UPDATE outbox SET status = 'pending'
+                WHERE status = 'sending' AND claimed_at <= ?
+            """, (lease_expired,))
+            return cursor.rowcount
+    
+    def get_outbox_due_times(self, lease_seconds: int = REMINDER_LEASE_SECONDS) -> List[Tuple]:
+        """(id, момент) напоминаний, ожидающих отправки; для ещё захваченных - конец аренды"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
             cursor.execute("""
-                SELECT s.user_id, u.username, SUM(s.total_bookings) as total_bookings
-                FROM stats s
-                LEFT JOIN users u ON s.user_id = u.user_id
-                WHERE s.year = ?
-                GROUP BY s.user_id
-                ORDER BY total_bookings DESC
-                LIMIT ?
-            """, (year, limit))
-        else:
-            # Топ за всё время
-            print("DEBUG: Запрос за всё время")
+                SELECT id, due_at FROM outbox WHERE status = 'pending'
+                UNION ALL
+                SELECT id, strftime(?, claimed_at, ?) FROM outbox WHERE status = 'sending'
+            """, (OUTBOX_FORMAT, f"+{int(lease_seconds)} seconds"))
+            due_times = cursor.fetchall()
+        return due_times
+    
+    def claim_reminders(self, limit: int = 50, lease_seconds: int = REMINDER_LEASE_SECONDS) -> List[Tuple]:
+        """Захват пачки наступивших напоминаний: (outbox_id, user_id, user_name, date, start_time, end_time)"""
+        now = datetime.now()
+        now_str = now.strftime(OUTBOX_FORMAT)
+        
+        with self.transaction(immediate=True) as conn:
+            cursor = conn.cursor()
+            
+            # Вложенная транзакция использует внешнюю: возврат и захват атомарны
+            self.release_expired_reminders(lease_seconds)
+            
             cursor.execute("""
-                SELECT s.user_id, u.username, SUM(s.total_bookings) as total_bookings
-                FROM stats s
-                LEFT JOIN users u ON s.user_id = u.user_id
-                GROUP BY s.user_id
-                ORDER BY total_bookings DESC
+                SELECT o.id, b.user_id, b.user_name, b.date, b.start_time, b.end_time, b.start_at
+                FROM outbox o
+                JOIN bookings b ON b.id = o.booking_id
+                WHERE o.status = 'pending' AND o.due_at <= ?
+                ORDER BY o.due_at
                 LIMIT ?
-            """, (limit,))
-        
-        results = cursor.fetchall()
-        print(f"DEBUG: Результаты запроса: {len(results)} записей")
-        for result in results:
-            print(f"  DEBUG: {result}")
-        
-        conn.close()
-        return results
+            """, (now_str, limit))
+            rows = cursor.fetchall()
+            
+            # Встреча уже началась - напоминать поздно
+            current = now.strftime(SORTABLE_FORMAT)
+            expired = [row[0] for row in rows if row[6] < current]
+            claimed = [row[:6] for row in rows if row[6] >= current]
+            
+            self._update_outbox(cursor, "status = 'expired'", (), expired)
+            self._update_outbox(cursor, "status = 'sending', claimed_at = ?, attempts = attempts + 1",
+                                (now_str,), [row[0] for row in claimed])
+        return claimed
+    
+    def ack_reminders(self, outbox_ids: List[int]) -> None:
+        """Подтверждение отправки: очередь и флаг notified обновляются одной транзакцией"""
+        if not outbox_ids:
+            return
+        now_str = datetime.now().strftime(OUTBOX_FORMAT)
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            for chunk in _chunks(outbox_ids):
+                placeholders = ", ".join("?" * len(chunk))
+                cursor.execute(f"""
+                    UPDATE bookings SET notified = TRUE
+                    WHERE id IN (SELECT booking_id FROM outbox WHERE id IN ({placeholders}))
+                """, chunk)
+            self._update_outbox(cursor, "status = 'sent', sent_at = ?, last_error = NULL", (now_str,), outbox_ids)
+    
+    def fail_reminders(self, outbox_ids: List[int], max_attempts: int = 5, backoff: float = 30.0) -> None:
+        """Возврат неотправленных напоминаний в очередь с нарастающей паузой"""
+        if not outbox_ids:
+            return
+        now = datetime.now()
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            for chunk in _chunks(outbox_ids):
+                placeholders = ", ".join("?" * len(chunk))
+                cursor.execute(f"SELECT id, attempts FROM outbox WHERE id IN ({placeholders})", chunk)
+                for outbox_id, attempts in cursor.fetchall():
+                    if attempts >= max_attempts:
+                        cursor.execute("UPDATE outbox SET status = 'failed' WHERE id = ?", (outbox_id,))
+                    else:
+                        retry_at = now + timedelta(seconds=backoff * 2 ** max(attempts - 1, 0))
+                        cursor.execute("""
+                            UPDATE outbox SET status = 'pending', due_at = ? WHERE id = ?
+                        """, (retry_at.strftime(OUTBOX_FORMAT), outbox_id))
+    
+    def _update_outbox(self, cursor, assignments: str, params: Tuple, outbox_ids: List[int]) -> None:
+        for chunk in _chunks(outbox_ids):
+            placeholders = ", ".join("?" * len(chunk))
+            cursor.execute(f"UPDATE outbox SET {assignments} WHERE id IN ({placeholders})", (*params, *chunk))
+    
+    def get_top_users_by_bookings(self, year: int = None, month: int = None, limit: int = 3) -> List[Tuple]:
+        """Получение топ пользователей по количеству бронирований (из рейтингов в памяти)"""
+        return self.leaderboards.top(year, month, 'bookings', limit)
 
     def get_top_users_by_duration(self, year: int = None, month: int = None, limit: int = 3) -> List[Tuple]:
-        """Получение топ пользователей по длительности бронирования"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        print(f"DEBUG: get_top_users_by_duration ? called with year={year}, month={month}, limit={limit}")  # Отладка
-        
-        if year is not None and month is not None:
-            # Топ за конкретный месяц
-            print(f"DEBUG: Запрос за конкретный месяц: {year}-{month:02d}")
-            cursor.execute("""
-                SELECT s.user_id, u.username, s.total_duration_minutes
-                FROM stats s
-                LEFT JOIN users u ON s.user_id = u.user_id
-                WHERE s.year = ? AND s.month = ?
-                ORDER BY s.total_duration_minutes DESC
-                LIMIT ?
-            """, (year, month, limit))
-        elif year is not None:
-            # Топ за конкретный год
-            print(f"DEBUG: Запрос за конкретный год: {year}")
-            cursor.execute("""
-                SELECT s.user_id, u.username, SUM(s.total_duration_minutes) as total_duration
-                FROM stats s
-                LEFT JOIN users u ON s.user_id = u.user_id
-                WHERE s.year = ?
-                GROUP BY s.user_id
-                ORDER BY total_duration DESC
-                LIMIT ?
-            """, (year, limit))
-        else:
-            # Топ за всё время
-            print("DEBUG: Запрос за всё время")
-            cursor.execute("""
-                SELECT s.user_id, u.username, SUM(s.total_duration_minutes) as total_duration
-                FROM stats s
-                LEFT JOIN users u ON s.user_id = u.user_id
-                GROUP BY s.user_id
-                ORDER BY total_duration DESC
-                LIMIT ?
-            """, (limit,))
-        
-        results = cursor.fetchall()
-        print(f"DEBUG: Результаты запроса: {len(results)} записей")
-        for result in results:
-            print(f"  DEBUG: {result}")
-        
-        conn.close()
-        return results
+        """Получение топ пользователей по длительности бронирования (из рейтингов в памяти)"""
+        return self.leaderboards.top(year, month, 'duration', limit)
 
 # Глобальный экземпляр менеджера базы данных
 db_manager = None
 
-def init_db_manager(db_file: str) -> DatabaseManager:
+def init_db_manager(db_file: str, pool_size: int = 5, reminder_minutes: int = None) -> DatabaseManager:
     """Инициализация менеджера базы данных"""
     global db_manager
-    db_manager = DatabaseManager(db_file)
+    if db_manager is not None:
+        db_manager.close()
+    db_manager = DatabaseManager(db_file, pool_size, reminder_minutes=reminder_minutes)
     return db_manager
 
 def get_db_manager() -> DatabaseManager:
@@ -412,4 +735,11 @@ def get_db_manager() -> DatabaseManager:
     global db_manager
     if db_manager is None:
         raise RuntimeError("Database manager not initialized")
-    return db_manager
\ No newline at end of file
+    return db_manager
+
+def close_db_manager() -> None:
+    """Закрытие соединений менеджера базы данных при остановке"""
+    global db_manager
+    if db_manager is not None:
+        db_manager.close()
+        db_manager = None
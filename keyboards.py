@@ -0,0 +1,111 @@
+import threading
+from datetime import date as date_cls, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+def to_minutes(time_str: str) -> int:
+    """HH:MM -> минуты от начала суток"""
+    hours, minutes = time_str.split(":")
+    return int(hours) * 60 + int(minutes)
+
+class KeyboardCache:
+    """Заранее построенные клавиатуры бронирования.
+
+    Зависят только от текущей даты и настроек, поэтому строятся один раз
+    и перестраиваются при смене суток или перезагрузке конфигурации.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._key = None
+        self._durations: Dict[Tuple[str, Optional[int]], InlineKeyboardMarkup] = {}
+
+    def _refresh(self):
+        key = (date_cls.today(), self.config.version)
+        if key != self._key:
+            with self._lock:
+                if key != self._key:
+                    self._build(*key)
+
+    def _build(self, today: date_cls, config_version: int):
+        config = self.config
+
+        # Даты: матрица по 2 кнопки в строке
+        self._dates = [(today + timedelta(days=i)).strftime("%d.%m.%Y")
+                       for i in range(config.booking_range_days)]
+        keyboard = [
+            [InlineKeyboardButton(d, callback_data=f"date_{d}") for d in self._dates[i:i+2]]
+            for i in range(0, len(self._dates), 2)
+        ]
+        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="main_menu")])
+        self._date_keyboard = InlineKeyboardMarkup(keyboard)
+
+        # Время начала: каждые полчаса рабочего дня; для каждого - свободная и занятая кнопка
+        start_hour = config.get_working_start_time().hour
+        end_hour = config.get_working_end_time().hour
+        times = []
+        for hour in range(start_hour, end_hour + 1):
+            times.append(f"{hour:02d}:00")
+            if hour < end_hour:
+                times.append(f"{hour:02d}:30")
+        self._times = times
+        self._time_buttons = {
+            t: (InlineKeyboardButton(t, callback_data=f"start_{t}"),
+                InlineKeyboardButton(f"🔒 {t}", callback_data=f"disabled_{t}"))
+            for t in times
+        }
+        self._time_back = [InlineKeyboardButton("⬅️ Назад", callback_data="book_room")]
+        self._free_time_keyboard = self._time_markup(set())
+
+        # Продолжительности
+        self._duration_buttons = [
+            (minutes, InlineKeyboardButton(text, callback_data=f"duration_{minutes}"))
+            for minutes, text in config.get_time_intervals_formatted()
+        ]
+        self._durations = {}
+
+        self._key = (today, config_version)
+
+    def _time_markup(self, occupied: Set[str]) -> InlineKeyboardMarkup:
+        # Матрица по 4 кнопки в строке
+        keyboard = [
+            [self._time_buttons[t][t in occupied] for t in self._times[i:i+4]]
+            for i in range(0, len(self._times), 4)
+        ]
+        keyboard.append(self._time_back)
+        return InlineKeyboardMarkup(keyboard)
+
+    def dates(self) -> List[str]:
+        self._refresh()
+        return self._dates
+
+    def times(self) -> List[str]:
+        self._refresh()
+        return self._times
+
+    def date_keyboard(self) -> InlineKeyboardMarkup:
+        self._refresh()
+        return self._date_keyboard
+
+    def time_keyboard(self, occupied: Set[str]) -> InlineKeyboardMarkup:
+        """Клавиатура времени начала; занятое время - неактивными кнопками"""
+        self._refresh()
+        if not occupied:
+            return self._free_time_keyboard
+        return self._time_markup(occupied)
+
+    def duration_keyboard(self, date: str, start_time: str, next_start: str = None) -> InlineKeyboardMarkup:
+        """Клавиатура продолжительности; без вариантов, заходящих на next_start"""
+        self._refresh()
+        limit = to_minutes(next_start) - to_minutes(start_time) if next_start else None
+        key = (date, limit)
+        markup = self._durations.get(key)
+        if markup is None:
+            buttons = [button for minutes, button in self._duration_buttons
+                       if limit is None or minutes <= limit]
+            keyboard = [buttons[i:i+2] for i in range(0, len(buttons), 2)]
+            keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data=f"date_{date}")])
+            markup = self._durations[key] = InlineKeyboardMarkup(keyboard)
+        return markup
@@ -0,0 +1,180 @@
+import heapq
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from schedule_index import DataVersionWatcher, read_data_version
+
+# Период рейтинга: (year, month) - месяц, (year, None) - год, (None, None) - всё время
+Period = Tuple[Optional[int], Optional[int]]
+# Изменение статистики: (user_id, year, month, бронирований, минут)
+StatsDelta = Tuple[int, int, int, int, int]
+
+METRICS = {'bookings': 0, 'duration': 1}
+
+def periods_of(year: int, month: int) -> Tuple[Period, Period, Period]:
+    """Все периоды, в которые входит месяц"""
+    return (year, month), (year, None), (None, None)
+
+# Источник итогов периода: сводные таблицы, поддерживаемые триггерами на stats
+def _period_query(period: Period) -> Tuple[str, tuple]:
+    year, month = period
+    if month is not None:
+        return ("SELECT user_id, total_bookings, total_duration_minutes FROM stats "
+                "WHERE year = ? AND month = ?", (year, month))
+    if year is not None:
+        return ("SELECT user_id, total_bookings, total_duration_minutes FROM stats_yearly "
+                "WHERE year = ?", (year,))
+    return "SELECT user_id, total_bookings, total_duration_minutes FROM stats_all_time", ()
+
+class Leaderboards:
+    """Рейтинги пользователей за месяц, год и всё время в памяти.
+
+    Итоги периода загружаются из сводных таблиц при первом обращении и дальше
+    обновляются на каждом бронировании и отмене; топ-N пересчитывается только
+    для затронутых периодов. Запись в stats в обход DatabaseManager замечается
+    по счётчикам data_versions и ведёт к перезагрузке.
+    """
+
+    def __init__(self, db_manager):
+        self._db = db_manager
+        self._lock = threading.RLock()
+        self._totals: Dict[Period, Dict[int, List[int]]] = {}   # только загруженные периоды
+        self._names: Optional[Dict[int, str]] = None
+        self._tops: Dict[Tuple[Period, str, int], List[Tuple]] = {}
+        self._stats_version = None  # версия stats, которой соответствуют _totals
+        self._users_version = None  # версия users, которой соответствуют _names
+        self._watcher = DataVersionWatcher(db_manager.get_connection)
+
+    def _sync(self):
+        """Сброс, если stats или users изменили в обход нас (другой процесс, скрипт)"""
+        if not self._watcher.poll():
+            return
+
+        stats_version = read_data_version(self._watcher.conn, 'stats')
+        if stats_version != self._stats_version:
+            self._totals.clear()
+            self._tops.clear()
+            self._stats_version = stats_version
+        if read_data_version(self._watcher.conn, 'users') != self._users_version:
+            self._names = None
+            self._tops.clear()
+
+    def _period(self, period: Period) -> Dict[int, List[int]]:
+        users = self._totals.get(period)
+        if users is None:
+            # Версия и строки читаются в одной транзакции, чтобы снимок был согласован
+            query, params = _period_query(period)
+            with self._db.transaction() as conn:
+                version = read_data_version(conn, 'stats')
+                rows = conn.execute(query, params).fetchall()
+            if version != self._stats_version:
+                self._totals.clear()
+                self._tops.clear()
+                self._stats_version = version
+            users = self._totals[period] = {user_id: [bookings, minutes] for user_id, bookings, minutes in rows}
+        return users
+
+    def _user_names(self) -> Dict[int, str]:
+        if self._names is None:
+            with self._db.transaction() as conn:
+                self._users_version = read_data_version(conn, 'users')
+                self._names = dict(conn.execute("SELECT user_id, username FROM users").fetchall())
+        return self._names
+
+    def rebuild(self):
+        """Перезагрузка рейтингов текущего месяца, года и всего времени"""
+        now = datetime.now()
+        with self._lock:
+            self.invalidate()
+            self._sync()
+            for period in periods_of(now.year, now.month):
+                self._period(period)
+            self._user_names()
+
+    def invalidate(self):
+        """Сброс; рейтинги будут загружены заново при обращении"""
+        with self._lock:
+            self._totals.clear()
+            self._tops.clear()
+            self._names = None
+            self._stats_version = None
+            self._users_version = None
+            self._watcher.reset()
+
+    def _apply(self, current: Optional[int], before: int, after: int) -> bool:
+        """Можно ли применить собственную запись (версии before -> after) к состоянию с версией current"""
+        if current is None or after <= current:
+            # Ничего не загружено или уже перечитано после этой записи
+            return False
+        return before == current
+
+    def apply_stats(self, before: int, after: int, deltas: List[StatsDelta]):
+        """Запись насквозь после изменения stats (версии stats до и после транзакции)"""
+        with self._lock:
+            if not self._apply(self._stats_version, before, after):
+                if self._stats_version is not None and after > self._stats_version:
+                    # Между нами вклинилась чужая запись - перечитываем
+                    self._totals.clear()
+                    self._tops.clear()
+                    self._stats_version = after
+                return
+
+            for user_id, year, month, bookings, minutes in deltas:
+                for period in periods_of(year, month):
+                    users = self._totals.get(period)
+                    if users is None:
+                        continue
+                    entry = users.setdefault(user_id, [0, 0])
+                    entry[0] += bookings
+                    entry[1] += minutes
+                    if entry[0] <= 0:
+                        del users[user_id]
+                    for key in [key for key in self._tops if key[0] == period]:
+                        del self._tops[key]
+            self._stats_version = after
+
+    def apply_user(self, before: int, after: int, user_id: int, username: str):
+        """Запись насквозь после изменения имени пользователя"""
+        with self._lock:
+            if self._names is None:
+                return
+            if not self._apply(self._users_version, before, after):
+                if self._users_version is not None and after > self._users_version:
+                    self._names = None
+                    self._tops.clear()
+                return
+
+            self._names[user_id] = username
+            self._tops.clear()
+            self._users_version = after
+
+    def top(self, year: int = None, month: int = None, metric: str = 'bookings', limit: int = 3) -> List[Tuple]:
+        """Топ-N за период: [(user_id, username, значение), ...] по убыванию"""
+        column = METRICS[metric]
+        period = (year, month if year is not None else None)
+        with self._lock:
+            self._sync()
+            key = (period, metric, limit)
+            result = self._tops.get(key)
+            if result is None:
+                users = self._period(period)
+                names = self._user_names()
+                best = heapq.nsmallest(limit, users.items(), key=lambda item: (-item[1][column], item[0]))
+                result = self._tops[key] = [
+                    (user_id, names.get(user_id), values[column]) for user_id, values in best
+                ]
+            return list(result)
+
+    @contextmanager
+    def suspended(self):
+        """Рейтинги недоступны на время блока (замена файла базы); после - загрузка заново"""
+        with self._lock:
+            self.close()
+            yield
+
+    def close(self):
+        with self._lock:
+            self._watcher.close()
+            self.invalidate()
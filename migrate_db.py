@@ -0,0 +1,50 @@
+import sys
+import os
+
+# Добавляем текущую директорию в путь Python
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from database import DatabaseManager
+from migrations import LATEST_VERSION, migrate, pending_migrations
+
+def migrate_db(db_file="meeting_room.db", batch_size=500, pause=0.05):
+    """Применение миграций к базе (можно запускать при работающем боте)"""
+    
+    print(f"=== Миграция базы: {db_file} ===")
+    
+    if not os.path.exists(db_file):
+        print(f"❌ Файл базы данных {db_file} не найден!")
+        return
+    
+    db_manager = DatabaseManager(db_file, auto_migrate=False)
+    try:
+        pending = pending_migrations(db_manager)
+        if not pending:
+            print(f"✅ Схема актуальна (версия {LATEST_VERSION})")
+            return
+        
+        print("Ожидающие миграции:")
+        for step in pending:
+            print(f"  {step.version}. {step.description}")
+        
+        # Перенос данных идёт пачками с паузами, чтобы бот успевал записывать между ними
+        version = migrate(db_manager, batch_size=batch_size, pause=pause)
+        print(f"✅ Версия схемы: {version}")
+    finally:
+        db_manager.close()
+
+def main():
+    if len(sys.argv) > 1:
+        db_file = sys.argv[1]
+    else:
+        db_file = "meeting_room.db"
+    
+    try:
+        migrate_db(db_file)
+    except Exception as e:
+        print(f"Ошибка при миграции базы: {e}")
+        import traceback
+        traceback.print_exc()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,514 @@
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+class Migration(NamedTuple):
+    """Шаг миграции схемы базы данных"""
+    version: int
+    description: str
+    upgrade: Callable                    # upgrade(conn) - DDL, выполняется в одной транзакции
+    backfill: Optional[Callable] = None  # backfill(conn, batch_size) -> число обработанных строк
+
+# Корректная дата в формате DD.MM.YYYY
+DATE_GLOB = "'[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]'"
+
+def sortable_sql(date_column: str, time_column: str) -> str:
+    """SQL-выражение: DD.MM.YYYY + HH:MM -> YYYY-MM-DD HH:MM"""
+    return (f"substr({date_column}, 7, 4) || '-' || substr({date_column}, 4, 2) || '-' || "
+            f"substr({date_column}, 1, 2) || ' ' || {time_column}")
+
+def get_version(conn) -> int:
+    """Текущая версия схемы из PRAGMA user_version"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def add_column(conn, table: str, column: str, declaration: str) -> None:
+    """Добавление колонки, если её ещё нет (шаги миграции должны быть повторяемыми)"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+# --- Шаги миграций ---
+
+def _create_base_schema(conn):
+    c = conn.cursor()
+
+    # Таблица бронирований
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS bookings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            user_name TEXT,
+            date TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            notified BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица для отслеживания пользователей
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Таблица для хранения статистики
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            year INTEGER,
+            month INTEGER,
+            total_bookings INTEGER DEFAULT 0,
+            total_duration_minutes INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Индексы для улучшения производительности
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bookings_date ON bookings(date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bookings_user_id ON bookings(user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stats_user_year_month ON stats(user_id, year, month)')
+
+def _add_sortable_datetimes(conn):
+    c = conn.cursor()
+
+    add_column(conn, 'bookings', 'start_at', 'TEXT')
+    add_column(conn, 'bookings', 'end_at', 'TEXT')
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bookings_start_at ON bookings(start_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bookings_user_start_at ON bookings(user_id, start_at)')
+
+    # Триггеры поддерживают колонки и для сторонних скриптов, пишущих только date/start_time/end_time
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_sortable_insert
+        AFTER INSERT ON bookings
+        WHEN NEW.start_at IS NULL AND NEW.date GLOB {DATE_GLOB}
+        BEGIN
+            UPDATE bookings
+            SET start_at = {sortable_sql('NEW.date', 'NEW.start_time')},
+                end_at = {sortable_sql('NEW.date', 'NEW.end_time')}
+            WHERE id = NEW.id;
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_sortable_update
+        AFTER UPDATE OF date, start_time, end_time ON bookings
+        WHEN NEW.date GLOB {DATE_GLOB}
+        BEGIN
+            UPDATE bookings
+            SET start_at = {sortable_sql('NEW.date', 'NEW.start_time')},
+                end_at = {sortable_sql('NEW.date', 'NEW.end_time')}
+            WHERE id = NEW.id;
+        END
+    ''')
+
+def _backfill_sortable_datetimes(conn, batch_size: int) -> int:
+    # Строки с некорректной датой остаются NULL и не попадают в выборки
+    cursor = conn.execute(f'''
+        UPDATE bookings
+        SET start_at = {sortable_sql('date', 'start_time')},
+            end_at = {sortable_sql('date', 'end_time')}
+        WHERE id IN (
+            SELECT id FROM bookings
+            WHERE start_at IS NULL AND date GLOB {DATE_GLOB}
+            LIMIT ?
+        )
+    ''', (batch_size,))
+    return cursor.rowcount
+
+def _add_data_versions(conn):
+    c = conn.cursor()
+
+    # Счётчики изменений: позволяют кэшам в памяти заметить запись из другого процесса
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('bookings', 0)")
+
+    bump = "UPDATE data_versions SET version = version + 1 WHERE name = 'bookings';"
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_version_insert
+        AFTER INSERT ON bookings
+        BEGIN {bump} END
+    ''')
+    # notified и start_at / end_at на расписание не влияют
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_version_update
+        AFTER UPDATE OF user_id, user_name, date, start_time, end_time ON bookings
+        BEGIN {bump} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_bookings_version_delete
+        AFTER DELETE ON bookings
+        BEGIN {bump} END
+    ''')
+
+def _add_stats_unique_key(conn):
+    c = conn.cursor()
+
+    # Дубликаты месяца появлялись при параллельных бронированиях - суммируем их в самую раннюю строку
+    c.execute('''
+        UPDATE stats
+        SET total_bookings = (
+                SELECT SUM(s.total_bookings) FROM stats s
+                WHERE s.user_id = stats.user_id AND s.year = stats.year AND s.month = stats.month
+            ),
+            total_duration_minutes = (
+                SELECT SUM(s.total_duration_minutes) FROM stats s
+                WHERE s.user_id = stats.user_id AND s.year = stats.year AND s.month = stats.month
+            ),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE id IN (
+            SELECT MIN(id) FROM stats
+            GROUP BY user_id, year, month
+            HAVING COUNT(*) > 1
+        )
+    ''')
+    c.execute('''
+        DELETE FROM stats
+        WHERE id NOT IN (SELECT MIN(id) FROM stats GROUP BY user_id, year, month)
+    ''')
+
+    c.execute('DROP INDEX IF EXISTS idx_stats_user_year_month')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS ux_stats_user_year_month ON stats(user_id, year, month)')
+
+def _add_meta(conn):
+    # Служебные значения (например, отметка последнего пересчёта статистики)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+def _add_outbox(conn):
+    # Очередь напоминаний: заполняется в транзакции бронирования, разбирается планировщиком.
+    # status: pending -> sending -> sent | failed | expired
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            booking_id INTEGER NOT NULL UNIQUE,
+            due_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_at TEXT,
+            sent_at TEXT,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_outbox_status_due_at ON outbox(status, due_at)')
+
+def _add_booking_sessions(conn):
+    # Незавершённые бронирования (SQLiteSessionStore); updated_at - время Unix
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS booking_sessions (
+            user_id INTEGER PRIMARY KEY,
+            user_name TEXT,
+            state TEXT,
+            date TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_booking_sessions_updated_at ON booking_sessions(updated_at)')
+
+def _add_stats_users_versions(conn):
+    c = conn.cursor()
+
+    # Счётчики для кэша готовых сообщений: рейтинг зависит от stats и имён в users
+    for table, columns in (('stats', 'total_bookings, total_duration_minutes'), ('users', 'username')):
+        c.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (table,))
+        bump = f"UPDATE data_versions SET version = version + 1 WHERE name = '{table}';"
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_insert
+            AFTER INSERT ON {table}
+            BEGIN {bump} END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_update
+            AFTER UPDATE OF {columns} ON {table}
+            BEGIN {bump} END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_delete
+            AFTER DELETE ON {table}
+            BEGIN {bump} END
+        ''')
+
+# Сводные таблицы статистики и их ключевые колонки (одноимённые колонкам stats)
+ROLLUPS = {
+    'stats_yearly': ('user_id', 'year'),
+    'stats_all_time': ('user_id',),
+    'stats_monthly_totals': ('year', 'month'),
+}
+
+def _rollup_sql(table: str, row: str, sign: str) -> str:
+    """Прибавление (sign '+') или вычитание (sign '-') строки stats (OLD / NEW) в сводной таблице"""
+    keys = ROLLUPS[table]
+    key_columns = ", ".join(keys)
+    if sign == '+':
+        key_values = ", ".join(f"{row}.{key}" for key in keys)
+        return f"""
+            INSERT INTO {table} ({key_columns}, total_bookings, total_duration_minutes)
+            VALUES ({key_values}, {row}.total_bookings, {row}.total_duration_minutes)
+            ON CONFLICT ({key_columns}) DO UPDATE SET
+                total_bookings = total_bookings + excluded.total_bookings,
+                total_duration_minutes = total_duration_minutes + excluded.total_duration_minutes;
+        """
+    conditions = " AND ".join(f"{key} = {row}.{key}" for key in keys)
+    return f"""
+        UPDATE {table}
+        SET total_bookings = total_bookings - {row}.total_bookings,
+            total_duration_minutes = total_duration_minutes - {row}.total_duration_minutes
+        WHERE {conditions};
+        DELETE FROM {table} WHERE {conditions} AND total_bookings <= 0;
+    """
+
+def _add_stats_rollups(conn):
+    c = conn.cursor()
+
+    # Итоги по пользователю за год, за всё время и общие итоги месяца.
+    # Поддерживаются триггерами на stats в той же транзакции, что и сама строка месяца
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stats_yearly (
+            user_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            total_bookings INTEGER NOT NULL DEFAULT 0,
+            total_duration_minutes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, year)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stats_all_time (
+            user_id INTEGER PRIMARY KEY,
+            total_bookings INTEGER NOT NULL DEFAULT 0,
+            total_duration_minutes INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS stats_monthly_totals (
+            year INTEGER NOT NULL,
+            month INTEGER NOT NULL,
+            total_bookings INTEGER NOT NULL DEFAULT 0,
+            total_duration_minutes INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (year, month)
+        )
+    ''')
+
+    # Рейтинг за год загружает период целиком (WHERE year = ?), топ сортируется в памяти
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stats_yearly_year ON stats_yearly(year)')
+
+    add_new = "".join(_rollup_sql(table, 'NEW', '+') for table in ROLLUPS)
+    remove_old = "".join(_rollup_sql(table, 'OLD', '-') for table in ROLLUPS)
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_rollup_insert
+        AFTER INSERT ON stats
+        BEGIN {add_new} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_rollup_update
+        AFTER UPDATE OF user_id, year, month, total_bookings, total_duration_minutes ON stats
+        BEGIN {remove_old} {add_new} END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_rollup_delete
+        AFTER DELETE ON stats
+        BEGIN {remove_old} END
+    ''')
+
+    # Заполнение по уже накопленной статистике
+    for table in ROLLUPS:
+        c.execute(f"DELETE FROM {table}")
+    c.execute('''
+        INSERT INTO stats_yearly (user_id, year, total_bookings, total_duration_minutes)
+        SELECT user_id, year, SUM(total_bookings), SUM(total_duration_minutes)
+        FROM stats GROUP BY user_id, year HAVING SUM(total_bookings) > 0
+    ''')
+    c.execute('''
+        INSERT INTO stats_all_time (user_id, total_bookings, total_duration_minutes)
+        SELECT user_id, SUM(total_bookings), SUM(total_duration_minutes)
+        FROM stats GROUP BY user_id HAVING SUM(total_bookings) > 0
+    ''')
+    c.execute('''
+        INSERT INTO stats_monthly_totals (year, month, total_bookings, total_duration_minutes)
+        SELECT year, month, SUM(total_bookings), SUM(total_duration_minutes)
+        FROM stats GROUP BY year, month HAVING SUM(total_bookings) > 0
+    ''')
+
+# Таблицы, изменения которых пишутся в журнал для инкрементальных бекапов, и их первичные ключи.
+# Строка журнала содержит все колонки таблицы на момент миграции: при добавлении колонок
+# триггеры журнала нужно пересоздать
+JOURNALED_TABLES = {
+    'bookings': 'id',
+    'users': 'user_id',
+    'stats': 'id',
+}
+
+def _add_change_journal(conn):
+    c = conn.cursor()
+
+    # Журнал изменений: op = 'upsert' (row_data - вся строка) или 'delete' (только ключ).
+    # Бекап-дельта - строки журнала после предыдущего бекапа цепочки
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS change_journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            op TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            row_data TEXT NOT NULL,
+            changed_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime'))
+        )
+    ''')
+
+    _create_journal_triggers(conn)
+
+# Условие триггеров журнала: пишем только пока есть цепочка инкрементальных бекапов
+JOURNAL_CONDITION = "EXISTS (SELECT 1 FROM meta WHERE key = 'backup_chain')"
+
+def _create_journal_triggers(conn, when: str = ""):
+    c = conn.cursor()
+    when = f"WHEN {when}" if when else ""
+    
+    for table, key in JOURNALED_TABLES.items():
+        # Колонки берём из самой таблицы: в старых базах их меньше, чем в базовой схеме
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+        row = ", ".join(f"'{column}', NEW.{column}" for column in columns)
+        upsert = (f"INSERT INTO change_journal (table_name, op, row_id, row_data) "
+                  f"VALUES ('{table}', 'upsert', NEW.{key}, json_object({row}));")
+        delete = (f"INSERT INTO change_journal (table_name, op, row_id, row_data) "
+                  f"VALUES ('{table}', 'delete', OLD.{key}, json_object('{key}', OLD.{key}));")
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_journal_insert
+            AFTER INSERT ON {table} {when}
+            BEGIN {upsert} END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_journal_update
+            AFTER UPDATE ON {table} {when}
+            BEGIN {upsert} END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_journal_delete
+            AFTER DELETE ON {table} {when}
+            BEGIN {delete} END
+        ''')
+
+def _journal_only_with_chain(conn):
+    c = conn.cursor()
+    
+    # Без цепочки бекапов дельты никто не читает - журнал не ведём и не храним
+    for table in JOURNALED_TABLES:
+        for event in ('insert', 'update', 'delete'):
+            c.execute(f'DROP TRIGGER IF EXISTS trg_{table}_journal_{event}')
+    _create_journal_triggers(conn, JOURNAL_CONDITION)
+    c.execute(f'DELETE FROM change_journal WHERE NOT {JOURNAL_CONDITION}')
+
+def _add_stats_month_index(conn):
+    # Рейтинг за месяц читает stats по (year, month); ux_stats_user_year_month начинается с user_id
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_stats_year_month ON stats(year, month)')
+
+def _drop_rollup_top_indexes(conn):
+    c = conn.cursor()
+
+    # Индексы по итогам никто не читал по порядку: Leaderboards сортирует топ в памяти,
+    # а каждый пересчёт stats триггерами платил за их обновление
+    for index in ('idx_stats_yearly_bookings', 'idx_stats_yearly_duration',
+                  'idx_stats_all_time_bookings', 'idx_stats_all_time_duration'):
+        c.execute(f'DROP INDEX IF EXISTS {index}')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stats_yearly_year ON stats_yearly(year)')
+
+# Упорядоченный список миграций; новые шаги добавляются только в конец
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Базовая схема", _create_base_schema),
+    Migration(2, "Сортируемые колонки start_at / end_at", _add_sortable_datetimes, _backfill_sortable_datetimes),
+    Migration(3, "Счётчики версий данных", _add_data_versions),
+    Migration(4, "Уникальный ключ статистики (user_id, year, month)", _add_stats_unique_key),
+    Migration(5, "Таблица служебных значений meta", _add_meta),
+    Migration(6, "Очередь напоминаний outbox", _add_outbox),
+    Migration(7, "Сессии бронирования booking_sessions", _add_booking_sessions),
+    Migration(8, "Счётчики версий stats и users", _add_stats_users_versions),
+    Migration(9, "Сводные таблицы статистики за год, за всё время и по месяцам", _add_stats_rollups),
+    Migration(10, "Журнал изменений для инкрементальных бекапов", _add_change_journal),
+    Migration(11, "Журнал изменений только при активной цепочке бекапов", _journal_only_with_chain),
+    Migration(12, "Индекс статистики по месяцу", _add_stats_month_index),
+    Migration(13, "Индексы сводной статистики только для выборки периода", _drop_rollup_top_indexes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+def pending_migrations(db_manager) -> List[Migration]:
+    """Список ещё не применённых миграций"""
+    with db_manager.connection() as conn:
+        version = get_version(conn)
+    return [step for step in MIGRATIONS if step.version > version]
+
+def _backfill_pending(conn, version: int) -> bool:
+    """DDL шага уже применён, перенос данных не закончен"""
+    table = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'migration_backfills'"
+    ).fetchone()
+    if table is None:
+        return False
+    return conn.execute("SELECT 1 FROM migration_backfills WHERE version = ?", (version,)).fetchone() is not None
+
+def _set_backfill_pending(conn, version: int) -> None:
+    conn.execute("CREATE TABLE IF NOT EXISTS migration_backfills (version INTEGER PRIMARY KEY)")
+    conn.execute("INSERT OR IGNORE INTO migration_backfills (version) VALUES (?)", (version,))
+
+def migrate(db_manager, target: int = None, batch_size: int = 500, pause: float = 0.0) -> int:
+    """Применение недостающих миграций, возвращает итоговую версию схемы"""
+    target = LATEST_VERSION if target is None else target
+
+    with db_manager.connection() as conn:
+        version = get_version(conn)
+    if version >= target:
+        return version
+
+    for step in MIGRATIONS:
+        if step.version <= version or step.version > target:
+            continue
+
+        # DDL шага и новая версия схемы (или отметка о незаконченном переносе данных) -
+        # одна транзакция; версию перепроверяем под блокировкой записи, поэтому другой
+        # процесс или перезапуск после сбоя не выполнит DDL шага второй раз
+        with db_manager.transaction(immediate=True) as conn:
+            if get_version(conn) >= step.version:
+                version = step.version
+                continue
+            if not _backfill_pending(conn, step.version):
+                step.upgrade(conn)
+                if step.backfill is None:
+                    conn.execute(f"PRAGMA user_version = {int(step.version)}")
+                else:
+                    _set_backfill_pending(conn, step.version)
+
+        # Перенос данных - короткими повторяемыми транзакциями, не держа блокировку записи надолго
+        if step.backfill is not None:
+            while True:
+                with db_manager.transaction(immediate=True) as conn:
+                    processed = step.backfill(conn, batch_size)
+                if not processed:
+                    break
+                if pause:
+                    time.sleep(pause)
+
+            with db_manager.transaction(immediate=True) as conn:
+                if get_version(conn) < step.version:
+                    conn.execute(f"PRAGMA user_version = {int(step.version)}")
+                conn.execute("DELETE FROM migration_backfills WHERE version = ?", (step.version,))
+
+        print(f"Применена миграция {step.version}: {step.description}")
+        version = step.version
+
+    return version
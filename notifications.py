@@ -0,0 +1,250 @@
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List
+
+from database import OUTBOX_FORMAT, REMINDER_LEASE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Страховочный интервал: перечитываем очередь из базы, даже если ничего не произошло
+# (бронирования, добавленные другим процессом, в обход слушателей)
+RESYNC_INTERVAL = 3600
+
+class TokenBucket:
+    """Ведро токенов: в среднем rate операций в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Забрать токен; возвращает, сколько нужно подождать до его появления"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def idle_since(self, moment: float) -> bool:
+        with self._lock:
+            return self._updated < moment
+
+class ReminderDispatcher:
+    """Параллельная отправка напоминаний с ограничением частоты и повторами"""
+
+    # Лимиты Telegram: около 30 сообщений в секунду всего и 1 в секунду в один чат
+    def __init__(self, send_reminder, senders: int = 4, global_rate: float = 30,
+                 per_chat_rate: float = 1, max_attempts: int = 3, backoff: float = 2.0):
+        # send_reminder(reminder) бросает исключение при неудаче,
+        # reminder = (id, user_id, user_name, date, start_time, end_time);
+        # у исключения может быть retry_after (секунды), как у telegram.error.RetryAfter
+        self.send_reminder = send_reminder
+        self.per_chat_rate = per_chat_rate
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._global = TokenBucket(global_rate)
+        self._chats = {}
+        self._chats_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._pool = ThreadPoolExecutor(max_workers=senders, thread_name_prefix="reminder-sender")
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        with self._chats_lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                # Не даём словарю расти бесконечно: забываем чаты, которым давно не писали
+                if len(self._chats) > 1000:
+                    stale = time.monotonic() - 60
+                    self._chats = {key: b for key, b in self._chats.items() if not b.idle_since(stale)}
+                bucket = self._chats[chat_id] = TokenBucket(self.per_chat_rate, 1)
+            return bucket
+
+    def _send_with_retry(self, reminder) -> bool:
+        reminder_id, user_id = reminder[0], reminder[1]
+        for attempt in range(1, self.max_attempts + 1):
+            if self._stopping.is_set():
+                return False
+            self._chat_bucket(user_id).acquire()
+            self._global.acquire()
+            try:
+                self.send_reminder(reminder)
+                logger.info(f"Уведомление отправлено пользователю {user_id}")
+                return True
+            except Exception as e:
+                delay = getattr(e, 'retry_after', None) or self.backoff * 2 ** (attempt - 1)
+                logger.warning(f"Ошибка отправки уведомления пользователю {user_id} "
+                               f"(попытка {attempt}/{self.max_attempts}): {e}")
+                if attempt < self.max_attempts:
+                    self._stopping.wait(delay)
+        logger.error(f"Напоминание {reminder_id} не отправлено после {self.max_attempts} попыток")
+        return False
+
+    def dispatch(self, reminders) -> List[int]:
+        """Отправка пачки напоминаний; возвращает ID успешно отправленных"""
+        futures = [(reminder[0], self._pool.submit(self._send_with_retry, reminder)) for reminder in reminders]
+        return [reminder_id for reminder_id, future in futures if future.result()]
+
+    def stop(self):
+        """Прерывание ожиданий между повторами; начатые отправки доделываются"""
+        self._stopping.set()
+
+    def shutdown(self):
+        self.stop()
+        self._pool.shutdown(wait=True)
+
+class ReminderScheduler:
+    """Планировщик напоминаний: куча моментов отправки, поток спит до ближайшего из них"""
+
+    def __init__(self, db_manager, reminder_minutes: int, dispatcher: ReminderDispatcher,
+                 batch_size: int = 50, max_attempts: int = 5, retry_backoff: float = 30.0,
+                 lease_seconds: int = REMINDER_LEASE_SECONDS):
+        # Очередь живёт в таблице outbox; куча в памяти лишь подсказывает, когда проснуться
+        self.db_manager = db_manager
+        self.reminder_minutes = reminder_minutes
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.lease_seconds = lease_seconds
+        self._heap = []             # (момент отправки, id)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._reload = True
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self.db_manager.add_listener(self._on_db_event)
+        self._thread = threading.Thread(target=self._run, name="reminders", daemon=True)
+        self._thread.start()
+        logger.info("Планировщик напоминаний запущен")
+
+    def stop(self, timeout: float = 5.0):
+        """Немедленная остановка: поток будится событием, а не ждёт окончания сна"""
+        self._stopping.set()
+        self._wakeup.set()
+        # Отправители бросают повторы сразу, иначе поток ждал бы их паузы (до retry_after)
+        self.dispatcher.stop()
+        self.db_manager.remove_listener(self._on_db_event)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning("Поток напоминаний не завершился: зависла отправка в Telegram")
+            self._thread = None
+        self.dispatcher.shutdown()
+        logger.info("Планировщик напоминаний остановлен")
+
+    def _due_time(self, start: datetime) -> datetime:
+        return start - timedelta(minutes=self.reminder_minutes)
+
+    def schedule(self, booking_id: int, date: str, start_time: str):
+        """Добавление напоминания для нового бронирования"""
+        start = datetime.strptime(f"{date} {start_time}", "%d.%m.%Y %H:%M")
+        with self._lock:
+            heapq.heappush(self._heap, (self._due_time(start), booking_id))
+        self._wakeup.set()
+
+    def resync(self):
+        """Перечитать очередь из базы (после отмены или внешних изменений)"""
+        with self._lock:
+            self._reload = True
+        self._wakeup.set()
+
+    def _on_db_event(self, event: str, **data):
+        if event == "booking_added":
+            self.schedule(data['booking_id'], data['date'], data['start_time'])
+        elif event in ("bookings_cancelled", "database_replaced"):
+            self.resync()
+
+    def _load(self):
+        # Бронирования, записанные в обход DatabaseManager, тоже получают напоминание
+        self.db_manager.sync_outbox()
+        # Захваченные до падения процесса: просроченные сразу возвращаем в очередь,
+        # остальные попадут в кучу на момент окончания аренды
+        self.db_manager.release_expired_reminders(self.lease_seconds)
+        heap = []
+        for outbox_id, due_at in self.db_manager.get_outbox_due_times(self.lease_seconds):
+            heap.append((datetime.strptime(due_at, OUTBOX_FORMAT), outbox_id))
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap = heap
+            self._reload = False
+        logger.info(f"Загружено напоминаний в очередь: {len(heap)}")
+
+    def _pop_due(self, now: datetime) -> bool:
+        """Снять с кучи все наступившие моменты; True, если что-то наступило"""
+        due = False
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                heapq.heappop(self._heap)
+                due = True
+        return due
+
+    def _dispatch(self):
+        """Разбор наступивших напоминаний из outbox: захват пачки, отправка, подтверждение"""
+        while not self._stopping.is_set():
+            reminders = self.db_manager.claim_reminders(self.batch_size, self.lease_seconds)
+            if not reminders:
+                return
+
+            sent = self.dispatcher.dispatch(reminders)
+            # Отправленные подтверждаем и при остановке, иначе после перезапуска они уйдут повторно
+            self.db_manager.ack_reminders(sent)
+            if self._stopping.is_set():
+                # Неотправленные вернутся в очередь по истечении аренды при следующем запуске
+                return
+
+            sent_ids = set(sent)
+            failed = [reminder[0] for reminder in reminders if reminder[0] not in sent_ids]
+            if failed:
+                # Неотправленные возвращаются в outbox с новым сроком - перечитываем кучу
+                self.db_manager.fail_reminders(failed, self.max_attempts, self.retry_backoff)
+                self.resync()
+
+            if len(reminders) < self.batch_size:
+                return
+
+    def _next_timeout(self, now: datetime) -> float:
+        with self._lock:
+            if not self._heap:
+                return RESYNC_INTERVAL
+            delay = (self._heap[0][0] - now).total_seconds()
+        return max(0.0, min(delay, RESYNC_INTERVAL))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                # Сбрасываем событие до обработки: сигнал, пришедший во время неё, не потеряется
+                self._wakeup.clear()
+                if self._reload:
+                    self._load()
+
+                if self._pop_due(datetime.now()):
+                    self._dispatch()
+
+                timeout = self._next_timeout(datetime.now())
+                if not self._wakeup.wait(timeout):
+                    # Проснулись по таймауту без событий - страховочная сверка с базой
+                    if timeout >= RESYNC_INTERVAL:
+                        self._reload = True
+            except Exception as e:
+                logger.error(f"Ошибка в планировщике напоминаний: {e}")
+                self._stopping.wait(60)
@@ -0,0 +1,84 @@
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Tuple
+
+from schedule_index import DataVersionWatcher
+
+def read_data_versions(conn) -> Tuple[Tuple[str, int], ...]:
+    """Все счётчики изменений (см. миграции data_versions)"""
+    return tuple(conn.execute("SELECT name, version FROM data_versions ORDER BY name").fetchall())
+
+class RenderCache:
+    """Кэш готовых сообщений (текст, клавиатура), действительный до изменения данных.
+
+    Ключ версии - счётчики data_versions (бронирования, статистика), которые
+    поднимаются триггерами при любой записи, в том числе из другого процесса.
+    """
+
+    def __init__(self, db_manager, max_entries: int = 500):
+        self._db = db_manager
+        self.max_entries = max_entries
+        self._entries: Dict[Hashable, object] = {}
+        self._lock = threading.RLock()
+        self._version = None
+        self._watcher = DataVersionWatcher(db_manager.get_connection)
+        self.hits = 0
+        self.misses = 0
+
+    def _current_version(self):
+        # Счётчики перечитываем, только если кто-то что-то закоммитил
+        if self._watcher.poll() or self._version is None:
+            version = read_data_versions(self._watcher.conn)
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+        return self._version
+
+    def get(self, key: Hashable, render: Callable[[], object]):
+        """Готовое значение для key; render() вызывается только при промахе"""
+        with self._lock:
+            version = self._current_version()
+            if key in self._entries:
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        # Версия прочитана до рендера - данные в значении не старше неё
+        value = render()
+
+        with self._lock:
+            if self._version == version:
+                if len(self._entries) >= self.max_entries:
+                    # Вытесняем самую старую запись
+                    self._entries.pop(next(iter(self._entries)))
+                self._entries[key] = value
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+            self._watcher.reset()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    @contextmanager
+    def suspended(self):
+        """Кэш недоступен на время блока (замена файла базы); после - пустой"""
+        with self._lock:
+            self.close()
+            yield
+
+    def close(self):
+        with self._lock:
+            self._watcher.close()
+            self._entries.clear()
+            self._version = None
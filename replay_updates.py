@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Отправка записанных обновлений Telegram на локальный webhook бота.
+
+Бот запускается с updates.mode = "webhook" и webhook.register = false,
+после чего ему можно скармливать обновления из JSON-файлов:
+
+    python replay_updates.py update1.json updates.json
+"""
+
+import json
+import sys
+import urllib.request
+
+from config import config
+
+def load_updates(path):
+    """Одно обновление или список обновлений из файла"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    return data if isinstance(data, list) else [data]
+
+def post_update(url, update):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status
+
+def main():
+    if len(sys.argv) < 2:
+        print("Использование: python replay_updates.py <файл.json> [файл.json ...]")
+        sys.exit(1)
+
+    webhook = config.webhook
+    scheme = 'https' if webhook['cert'] and webhook['key'] else 'http'
+    url = f"{scheme}://{webhook['listen']}:{webhook['port']}/{config.get_webhook_path()}"
+
+    sent = 0
+    for path in sys.argv[1:]:
+        for update in load_updates(path):
+            status = post_update(url, update)
+            print(f"update_id={update.get('update_id')}: HTTP {status}")
+            sent += 1
+
+    print(f"Отправлено обновлений: {sent}")
+
+if __name__ == "__main__":
+    main()
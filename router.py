@@ -0,0 +1,196 @@
+import bisect
+import logging
+import re
+import threading
+import time
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограммы задержек, мс (последняя корзина - всё, что дольше)
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_DATE_RE = re.compile(r"\d{2}\.\d{2}\.\d{4}")
+_TIME_RE = re.compile(r"\d{2}:\d{2}")
+
+# --- Разбор полезной нагрузки callback_data ---
+
+def parse_date(payload: str) -> str:
+    """DD.MM.YYYY"""
+    if not _DATE_RE.fullmatch(payload):
+        raise ValueError(f"Invalid date: {payload!r}")
+    return payload
+
+def parse_time(payload: str) -> str:
+    """HH:MM"""
+    if not _TIME_RE.fullmatch(payload):
+        raise ValueError(f"Invalid time: {payload!r}")
+    return payload
+
+def parse_choice(*choices: str) -> Callable[[str], str]:
+    """Одно из фиксированных значений"""
+    def parse(payload: str) -> str:
+        if payload not in choices:
+            raise ValueError(f"Unexpected value: {payload!r}")
+        return payload
+    return parse
+
+class RouteStats:
+    """Счётчики маршрута: вызовы, ошибки и гистограмма задержек"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self._lock = threading.Lock()
+
+    def record(self, elapsed_ms: float, failed: bool):
+        with self._lock:
+            self.calls += 1
+            if failed:
+                self.errors += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Верхняя граница корзины, в которую попадает заданная доля вызовов"""
+        with self._lock:
+            if not self.calls:
+                return None
+            rank = fraction * self.calls
+            seen = 0
+            for i, count in enumerate(self.buckets):
+                seen += count
+                if seen >= rank:
+                    return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+            return self.max_ms
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            calls, errors, total_ms, max_ms = self.calls, self.errors, self.total_ms, self.max_ms
+            buckets = list(self.buckets)
+        return {
+            'calls': calls,
+            'errors': errors,
+            'avg_ms': total_ms / calls if calls else 0.0,
+            'max_ms': max_ms,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'buckets': buckets,
+        }
+
+class Route(NamedTuple):
+    name: str
+    handler: Callable
+    parse: Optional[Callable[[str], object]]   # None - точное совпадение, без полезной нагрузки
+    answer: bool                               # отвечать ли на запрос до вызова обработчика
+    concurrent: bool                           # только чтение: можно выполнять в пуле потоков
+
+class CallbackRouter:
+    """Маршрутизация нажатий кнопок: словарь точных совпадений и таблица префиксов"""
+
+    def __init__(self):
+        self._exact: Dict[str, Route] = {}
+        self._prefixes: Dict[str, Route] = {}
+        self._separator = "_"
+        self.stats: Dict[str, RouteStats] = {}
+        # Параллельное выполнение concurrent-маршрутов в пуле потоков диспетчера
+        self.run_concurrent = False
+        self._in_flight = 0
+        self._max_in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    def _register(self, table: Dict[str, Route], key: str, route: Route):
+        if key in table:
+            raise ValueError(f"Route already registered: {key!r}")
+        table[key] = route
+        self.stats[route.name] = RouteStats()
+
+    def exact(self, data: str, handler: Callable, answer: bool = True, concurrent: bool = False):
+        """handler(update, context) для callback_data == data"""
+        self._register(self._exact, data, Route(data, handler, None, answer, concurrent))
+
+    def prefix(self, prefix: str, handler: Callable, parse: Callable[[str], object] = str,
+               answer: bool = True, concurrent: bool = False):
+        """handler(update, context, payload) для callback_data вида '<prefix>_<payload>'"""
+        self._register(self._prefixes, prefix, Route(f"{prefix}_*", handler, parse, answer, concurrent))
+
+    def resolve(self, data: str) -> Tuple[Optional[Route], Optional[str]]:
+        """Маршрут и необработанная полезная нагрузка; поиск - O(1) при любом числе маршрутов"""
+        route = self._exact.get(data)
+        if route is not None:
+            return route, None
+        prefix, separator, payload = data.partition(self._separator)
+        if separator:
+            route = self._prefixes.get(prefix)
+            if route is not None:
+                return route, payload
+        return None, None
+
+    def dispatch(self, update, context) -> bool:
+        """Вызов обработчика для нажатой кнопки; False, если маршрут не найден"""
+        query = update.callback_query
+        route, payload = self.resolve(query.data or "")
+        if route is None:
+            query.answer()
+            logger.warning(f"Неизвестная кнопка: {query.data!r}")
+            return False
+
+        if route.answer:
+            query.answer()
+
+        if route.concurrent and self.run_concurrent and context is not None:
+            # Обработчик только читает - не держим очередь обновлений, отдаём его в пул
+            with self._in_flight_lock:
+                self._in_flight += 1
+                self._max_in_flight = max(self._max_in_flight, self._in_flight)
+            context.dispatcher.run_async(self._invoke_concurrent, route, update, context, payload, update=update)
+            return True
+
+        return self._invoke(route, update, context, payload)
+
+    def _invoke_concurrent(self, route: Route, update, context, payload: Optional[str]):
+        try:
+            self._invoke(route, update, context, payload)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight -= 1
+
+    def _invoke(self, route: Route, update, context, payload: Optional[str]) -> bool:
+        query = update.callback_query
+        started = time.perf_counter()
+        failed = True
+        try:
+            if route.parse is None:
+                route.handler(update, context)
+            else:
+                try:
+                    value = route.parse(payload)
+                except ValueError as e:
+                    logger.warning(f"Некорректные данные кнопки {query.data!r}: {e}")
+                    return True
+                route.handler(update, context, value)
+            failed = False
+        finally:
+            self.stats[route.name].record((time.perf_counter() - started) * 1000, failed)
+        return True
+
+    def metrics(self) -> Dict[str, dict]:
+        """Снимок метрик по всем маршрутам"""
+        return {name: stats.snapshot() for name, stats in self.stats.items()}
+
+    def concurrency_metrics(self) -> dict:
+        with self._in_flight_lock:
+            return {'in_flight': self._in_flight, 'max_in_flight': self._max_in_flight}
+
+    def format_metrics(self) -> str:
+        lines = []
+        for name, m in sorted(self.metrics().items()):
+            if not m['calls']:
+                continue
+            lines.append(f"{name}: вызовов {m['calls']}, ошибок {m['errors']}, "
+                         f"среднее {m['avg_ms']:.1f} мс, p95 <= {m['p95_ms']:.0f} мс, макс {m['max_ms']:.1f} мс")
+        return "\n".join(lines)
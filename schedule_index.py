@@ -0,0 +1,250 @@
+import bisect
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+# Запись индекса: (booking_id, user_id, user_name, start_time, end_time)
+Entry = Tuple[int, int, str, str, str]
+
+def read_data_version(conn, name: str) -> int:
+    """Счётчик изменений таблицы (см. миграции data_versions)"""
+    row = conn.execute("SELECT version FROM data_versions WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+def read_bookings_version(conn) -> int:
+    """Счётчик изменений таблицы bookings"""
+    return read_data_version(conn, 'bookings')
+
+class DataVersionWatcher:
+    """Проверка чужих коммитов через PRAGMA data_version на отдельном соединении.
+
+    data_version меняется при коммите любого другого соединения (в том числе из
+    другого процесса) и ничего не стоит, поэтому кэши перечитывают свои счётчики
+    data_versions только после poll() == True.
+    """
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._conn = None
+        self._data_version = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = self._connect()
+        return self._conn
+
+    def poll(self) -> bool:
+        """Были ли коммиты с прошлой проверки (первая проверка и проверка после reset() - да)"""
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self._data_version:
+            return False
+        self._data_version = data_version
+        return True
+
+    def reset(self):
+        self._data_version = None
+
+    def close(self):
+        """Закрытие соединения (например, перед заменой файла базы); следующий poll() откроет новое"""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._data_version = None
+
+class DaySchedule:
+    """Бронирования одного дня, отсортированные по времени начала"""
+
+    def __init__(self, entries: List[Entry]):
+        self.entries = sorted(entries, key=lambda e: (e[3], e[4]))
+        self._reindex()
+
+    def _reindex(self):
+        # Время в формате HH:MM сравнивается как строка.
+        # max_ends - префиксный максимум окончаний: корректен и при пересечениях в старых данных
+        self.starts = [e[3] for e in self.entries]
+        self.max_ends = []
+        current = ""
+        for entry in self.entries:
+            current = max(current, entry[4])
+            self.max_ends.append(current)
+
+    def add(self, entry: Entry):
+        position = bisect.bisect_right(self.starts, entry[3])
+        self.entries.insert(position, entry)
+        self._reindex()
+
+    def remove_user(self, user_id: int, since: str = "") -> bool:
+        """Удаление бронирований пользователя, начинающихся не раньше since (HH:MM)"""
+        entries = [e for e in self.entries if e[1] != user_id or e[3] < since]
+        if len(entries) == len(self.entries):
+            return False
+        self.entries = entries
+        self._reindex()
+        return True
+
+    def find_conflict(self, start_time: str, end_time: str) -> Optional[Entry]:
+        """Первое бронирование, пересекающееся с [start_time, end_time)"""
+        i = bisect.bisect_right(self.max_ends, start_time)
+        if i < len(self.entries) and self.entries[i][3] < end_time:
+            return self.entries[i]
+        return None
+
+    def is_occupied(self, time_str: str) -> bool:
+        """Занят ли момент time_str каким-либо бронированием"""
+        i = bisect.bisect_right(self.max_ends, time_str)
+        return i < len(self.entries) and self.entries[i][3] <= time_str
+
+    def next_start_after(self, time_str: str) -> Optional[str]:
+        """Начало ближайшего бронирования строго после time_str"""
+        i = bisect.bisect_right(self.starts, time_str)
+        return self.starts[i] if i < len(self.starts) else None
+
+    def free_gaps(self, day_start: str, day_end: str) -> List[Tuple[str, str]]:
+        """Свободные промежутки внутри рабочего дня"""
+        gaps = []
+        cursor = day_start
+        for entry in self.entries:
+            if entry[3] > cursor:
+                gaps.append((cursor, min(entry[3], day_end)))
+            cursor = max(cursor, entry[4])
+            if cursor >= day_end:
+                break
+        if cursor < day_end:
+            gaps.append((cursor, day_end))
+        return [(start, end) for start, end in gaps if start < end]
+
+class ScheduleIndex:
+    """Индекс бронирований по дням в памяти: ленивая загрузка из bookings и запись насквозь"""
+
+    def __init__(self, db_manager):
+        self._db = db_manager
+        self._days: Dict[str, DaySchedule] = {}
+        self._lock = threading.RLock()
+        self._version = None        # версия bookings, которой соответствует индекс
+        self._watcher = DataVersionWatcher(db_manager.get_connection)
+
+    def _sync(self):
+        """Сброс индекса, если bookings изменили в обход него (другой процесс, скрипт)"""
+        if not self._watcher.poll():
+            return
+
+        version = read_bookings_version(self._watcher.conn)
+        if version != self._version:
+            self._days.clear()
+            self._version = version
+
+    def _day(self, date: str) -> DaySchedule:
+        self._sync()
+        day = self._days.get(date)
+        if day is None:
+            # Версия и строки читаются в одной транзакции, чтобы снимок был согласован
+            with self._db.transaction() as conn:
+                version = read_bookings_version(conn)
+                rows = conn.execute("""
+                    SELECT id, user_id, user_name, start_time, end_time
+                    FROM bookings
+                    WHERE date = ?
+                """, (date,)).fetchall()
+            if version != self._version:
+                self._days.clear()
+                self._version = version
+            day = self._days[date] = DaySchedule(rows)
+        return day
+
+    def rebuild(self) -> int:
+        """Полная перезагрузка индекса: предстоящие дни загружаются сразу, прошедшие - по запросу"""
+        today = datetime.now().strftime("%Y-%m-%d")
+        with self._lock:
+            with self._db.transaction() as conn:
+                version = read_bookings_version(conn)
+                rows = conn.execute("""
+                    SELECT id, user_id, user_name, start_time, end_time, date
+                    FROM bookings
+                    WHERE start_at >= ?
+                """, (today,)).fetchall()
+
+            by_date: Dict[str, List[Entry]] = {}
+            for booking_id, user_id, user_name, start_time, end_time, date in rows:
+                by_date.setdefault(date, []).append((booking_id, user_id, user_name, start_time, end_time))
+
+            self._days = {date: DaySchedule(entries) for date, entries in by_date.items()}
+            self._version = version
+            self._watcher.reset()
+            return len(rows)
+
+    def invalidate(self):
+        """Сброс индекса; дни будут загружены заново при обращении"""
+        with self._lock:
+            self._days.clear()
+            self._version = None
+            self._watcher.reset()
+
+    def _apply(self, version: int) -> bool:
+        """Можно ли применить собственную запись с номером version к индексу"""
+        if self._version is None or version <= self._version:
+            # Индекс пуст или уже перечитан после этой записи
+            return False
+        if version != self._version + 1:
+            # Между нами вклинилась чужая запись - перечитываем
+            self._days.clear()
+            self._version = version
+            return False
+        self._version = version
+        return True
+
+    def add(self, version: int, booking_id: int, user_id: int, user_name: str,
+            date: str, start_time: str, end_time: str):
+        """Запись насквозь после сохранения бронирования"""
+        with self._lock:
+            if self._apply(version) and date in self._days:
+                self._days[date].add((booking_id, user_id, user_name, start_time, end_time))
+
+    def remove_user(self, version: int, user_id: int, since: datetime):
+        """Запись насквозь после отмены предстоящих (с момента since) бронирований пользователя"""
+        today = since.strftime("%Y-%m-%d")
+        with self._lock:
+            if self._apply(version):
+                for date, day in self._days.items():
+                    day_key = f"{date[6:10]}-{date[3:5]}-{date[0:2]}"
+                    if day_key > today:
+                        day.remove_user(user_id)
+                    elif day_key == today:
+                        day.remove_user(user_id, since.strftime("%H:%M"))
+
+    def find_conflict(self, date: str, start_time: str, end_time: str) -> Optional[Tuple]:
+        """(user_name, start_time, end_time) первого пересекающегося бронирования"""
+        with self._lock:
+            entry = self._day(date).find_conflict(start_time, end_time)
+        return entry[2:] if entry else None
+
+    def is_free(self, date: str, start_time: str, end_time: str) -> bool:
+        return self.find_conflict(date, start_time, end_time) is None
+
+    def occupied_times(self, date: str, times: List[str]) -> Set[str]:
+        """Какие из times заняты бронированиями (одна загрузка дня на весь список)"""
+        with self._lock:
+            day = self._day(date)
+            return {time_str for time_str in times if day.is_occupied(time_str)}
+
+    def next_start_after(self, date: str, time_str: str) -> Optional[str]:
+        with self._lock:
+            return self._day(date).next_start_after(time_str)
+
+    def free_gaps(self, date: str, day_start: str, day_end: str) -> List[Tuple[str, str]]:
+        with self._lock:
+            return self._day(date).free_gaps(day_start, day_end)
+
+    @contextmanager
+    def suspended(self):
+        """Индекс недоступен на время блока (замена файла базы); после - загрузка заново"""
+        with self._lock:
+            self.close()
+            yield
+
+    def close(self):
+        with self._lock:
+            self._watcher.close()
+            self._days.clear()
+            self._version = None
@@ -0,0 +1,142 @@
+import threading
+import time
+from typing import Dict, Optional
+
+class BookingSession:
+    """Состояние незавершённого бронирования одного пользователя"""
+
+    __slots__ = ('user_id', 'user_name', 'state', 'date', 'start_time', 'end_time', 'updated_at')
+
+    def __init__(self, user_id: int, user_name: str, state: str, date: str = None,
+                 start_time: str = None, end_time: str = None, updated_at: float = None):
+        self.user_id = user_id
+        self.user_name = user_name
+        self.state = state
+        self.date = date
+        self.start_time = start_time
+        self.end_time = end_time
+        self.updated_at = time.time() if updated_at is None else updated_at
+
+class SessionStore:
+    """Хранилище сессий бронирования в памяти с вытеснением брошенных сессий по TTL"""
+
+    def __init__(self, ttl: float = 1800, sweep_interval: float = 60):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._sessions: Dict[int, BookingSession] = {}
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+
+    def start(self, user_id: int, user_name: str, state: str) -> BookingSession:
+        """Новая сессия (предыдущая сессия пользователя отбрасывается)"""
+        session = BookingSession(user_id, user_name, state)
+        self.save(session)
+        return session
+
+    def get(self, user_id: int) -> Optional[BookingSession]:
+        with self._lock:
+            session = self._sessions.get(user_id)
+        if session is None:
+            session = self._load(user_id)
+            if session is not None:
+                with self._lock:
+                    self._sessions[user_id] = session
+        if session is not None and self._expired(session, time.time()):
+            self.delete(user_id)
+            return None
+        return session
+
+    def save(self, session: BookingSession) -> None:
+        session.updated_at = time.time()
+        with self._lock:
+            self._sessions[session.user_id] = session
+        self._persist(session)
+        self._maybe_sweep()
+
+    def delete(self, user_id: int) -> None:
+        with self._lock:
+            self._sessions.pop(user_id, None)
+        self._remove(user_id)
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _expired(self, session: BookingSession, now: float) -> bool:
+        return now - session.updated_at > self.ttl
+
+    def _maybe_sweep(self) -> None:
+        # Вытеснение попутно с записью, не чаще раза в sweep_interval
+        if time.time() - self._last_sweep >= self.sweep_interval:
+            self.evict_expired()
+
+    def evict_expired(self) -> int:
+        """Удаление просроченных сессий; возвращает их количество"""
+        now = time.time()
+        with self._lock:
+            self._last_sweep = now
+            expired = [user_id for user_id, s in self._sessions.items() if self._expired(s, now)]
+            for user_id in expired:
+                del self._sessions[user_id]
+        self._remove_expired(now - self.ttl)
+        return len(expired)
+
+    # Точки расширения для постоянного хранилища
+    def _load(self, user_id: int) -> Optional[BookingSession]:
+        return None
+
+    def _persist(self, session: BookingSession) -> None:
+        pass
+
+    def _remove(self, user_id: int) -> None:
+        pass
+
+    def _remove_expired(self, cutoff: float) -> None:
+        pass
+
+class SQLiteSessionStore(SessionStore):
+    """Хранилище сессий с копией в SQLite: начатое бронирование переживает перезапуск бота"""
+
+    def __init__(self, db_manager, ttl: float = 1800, sweep_interval: float = 60, writer=None):
+        super().__init__(ttl, sweep_interval)
+        self.db_manager = db_manager
+        # writer(func, *args) - выполнение записи (в боте - через очередь записей write_db)
+        self.writer = writer
+
+    def _write(self, func, *args):
+        if self.writer is None:
+            return func(*args)
+        return self.writer(func, *args)
+
+    def _load(self, user_id: int) -> Optional[BookingSession]:
+        with self.db_manager.connection() as conn:
+            row = conn.execute("""
+                SELECT user_id, user_name, state, date, start_time, end_time, updated_at
+                FROM booking_sessions
+                WHERE user_id = ?
+            """, (user_id,)).fetchone()
+        return BookingSession(*row) if row else None
+
+    def _persist(self, session: BookingSession) -> None:
+        self._write(self._persist_row, session.user_id, session.user_name, session.state,
+                    session.date, session.start_time, session.end_time, session.updated_at)
+
+    def _persist_row(self, *row) -> None:
+        with self.db_manager.transaction() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO booking_sessions
+                    (user_id, user_name, state, date, start_time, end_time, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, row)
+
+    def _remove(self, user_id: int) -> None:
+        self._write(self._execute, "DELETE FROM booking_sessions WHERE user_id = ?", (user_id,))
+
+    def _remove_expired(self, cutoff: float) -> None:
+        self._write(self._execute, "DELETE FROM booking_sessions WHERE updated_at < ?", (cutoff,))
+
+    def _execute(self, sql: str, params: tuple) -> None:
+        with self.db_manager.transaction() as conn:
+            conn.execute(sql, params)
@@ -61,13 +61,31 @@ def view_stats(db_file="meeting_room.db"):
         # Показываем агрегированную статистику
         print("=== Агрегированная статистика ===")
         
+        # Сводные таблицы (миграция 9) ведутся триггерами - итоги читаются без GROUP BY;
+        # в базе без миграции суммируем помесячные строки
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='stats_all_time';")
+        if cursor.fetchone():
+            all_time_source = "stats_all_time"
+            monthly_source = "stats_monthly_totals"
+        else:
+            print("(сводные таблицы не найдены - запустите migrate_db.py; итоги считаются по stats)")
+            all_time_source = """(
+                SELECT user_id, SUM(total_bookings) AS total_bookings,
+                       SUM(total_duration_minutes) AS total_duration_minutes
+                FROM stats GROUP BY user_id
+            )"""
+            monthly_source = """(
+                SELECT year, month, SUM(total_bookings) AS total_bookings,
+                       SUM(total_duration_minutes) AS total_duration_minutes
+                FROM stats GROUP BY year, month
+            )"""
+        
         # Топ пользователей по количеству бронирований за всё время
-        cursor.execute("""
-            SELECT s.user_id, u.username, SUM(s.total_bookings) as total_bookings
-            FROM stats s
+        cursor.execute(f"""
+            SELECT s.user_id, u.username, s.total_bookings
+            FROM {all_time_source} s
             LEFT JOIN users u ON s.user_id = u.user_id
-            GROUP BY s.user_id
-            ORDER BY total_bookings DESC
+            ORDER BY s.total_bookings DESC
             LIMIT 10
         """)
         
@@ -78,12 +96,11 @@ def view_stats(db_file="meeting_room.db"):
             print(f"  {i:2d}. {username:<15} - {total} бронирований")
         
         # Топ пользователей по длительности за всё время
-        cursor.execute("""
-            SELECT s.user_id, u.username, SUM(s.total_duration_minutes) as total_duration
-            FROM stats s
+        cursor.execute(f"""
+            SELECT s.user_id, u.username, s.total_duration_minutes
+            FROM {all_time_source} s
             LEFT JOIN users u ON s.user_id = u.user_id
-            GROUP BY s.user_id
-            ORDER BY total_duration DESC
+            ORDER BY s.total_duration_minutes DESC
             LIMIT 10
         """)
         
@@ -97,10 +114,9 @@ def view_stats(db_file="meeting_room.db"):
             print(f"  {i:2d}. {username:<15} - {duration_text} ({total_minutes} мин)")
         
         # Статистика по месяцам
-        cursor.execute("""
-            SELECT year, month, SUM(total_bookings) as monthly_bookings, SUM(total_duration_minutes) as monthly_duration
-            FROM stats
-            GROUP BY year, month
+        cursor.execute(f"""
+            SELECT year, month, total_bookings, total_duration_minutes
+            FROM {monthly_source}
             ORDER BY year DESC, month DESC
             LIMIT 10
         """)
@@ -0,0 +1,93 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+class WriteQueue:
+    """Единственный поток-писатель: записи в базу выполняются строго по очереди,
+    поэтому SQLite не видит конкуренции писателей"""
+
+    def __init__(self, max_size: int = 100, put_timeout: float = 10.0):
+        self.max_size = max_size
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=max_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._processed = 0
+        self._errors = 0
+        self._max_depth = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+        logger.info(f"Поток записи в базу запущен (очередь до {self.max_size})")
+
+    def stop(self, timeout: float = 10.0):
+        """Остановка после выполнения уже поставленных записей"""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        """Поставить запись в очередь; при переполненной очереди ждёт put_timeout секунд"""
+        if self._thread is None:
+            raise RuntimeError("Write queue is not running")
+        future = Future()
+        try:
+            self._queue.put((future, time.monotonic(), func, args, kwargs), timeout=self.put_timeout)
+        except queue.Full:
+            raise RuntimeError("Write queue is full") from None
+        with self._lock:
+            self._max_depth = max(self._max_depth, self._queue.qsize())
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """Выполнить запись в потоке-писателе и дождаться результата"""
+        if threading.current_thread() is self._thread:
+            # Запись изнутри другой записи - очередь ждала бы сама себя
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, queued_at, func, args, kwargs = item
+            wait = time.monotonic() - queued_at
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+            finally:
+                with self._lock:
+                    self._processed += 1
+                    self._total_wait += wait
+                    self._max_wait = max(self._max_wait, wait)
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return {
+                'depth': self._queue.qsize(),
+                'max_depth': self._max_depth,
+                'max_size': self.max_size,
+                'processed': self._processed,
+                'errors': self._errors,
+                'avg_wait_ms': self._total_wait / self._processed * 1000 if self._processed else 0.0,
+                'max_wait_ms': self._max_wait * 1000,
+            }